@@ -1,61 +1,683 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
+# Reads the binary files written by dnsdist's LogAction(binary=true).
+#
+# For files written with timestamps, a sparse index can be kept next to the
+# log, in <log>.idx, to quickly find the records of a time range: a magic and
+# the number of records between two entries (little-endian 32-bit integer),
+# followed by one entry every that many records holding the tv_sec of the
+# record and its offset in the log, both as little-endian 64-bit integers.
+#
+# The records can also be converted to pcap or dnstap (frame streams) files,
+# to be fed to existing DNS tools. The log only holds the query ID, qname,
+# qtype and source of the queries, so the converter synthesizes a query with
+# the RD bit set, sent over UDP to a configurable destination.
+
+import argparse
+import bisect
+import collections
+import datetime
+import functools
+import heapq
+import mmap
+import multiprocessing
+import os
 import socket
 import struct
 import sys
+import time
 
-def readRecord(fp, withTimestamp):
+# qname is kept in wire format, see getQNameAsString()
+LogActionRecord = collections.namedtuple('LogActionRecord', ['offset', 'length', 'tv_sec', 'tv_nsec', 'queryID', 'qname', 'qtype', 'addrType', 'addr', 'port'])
 
-    if withTimestamp:
-        data = fp.read(12)
-        if not data:
-            return False
-        tv_sec, tv_nsec = struct.unpack("QI", data)
+timestampStruct = struct.Struct("QI")
+queryIDStruct = struct.Struct("!H")
+typesStruct = struct.Struct("HH")
+portStruct = struct.Struct("!H")
 
-    data = fp.read(2)
-    if not data:
-        return False
+addrLengths = {socket.AF_INET: 4, socket.AF_INET6: 16}
+
+INDEX_MAGIC = b'PDNSLAI1'
+INDEX_HEADER = struct.Struct('<8sI')
+INDEX_ENTRY = struct.Struct('<QQ')
+
+def readRecords(data, withTimestamps, offset=0, end=None):
+    """
+    Yields a LogActionRecord for every complete record found in data (for
+    example a mmap of a LogAction file) between offset and end. Stops
+    silently on a truncated trailing record, which dnsdist might still be
+    writing. Raises ValueError on an unsupported address type.
+    """
+    if end is None:
+        end = len(data)
+
+    unpackTimestamp = timestampStruct.unpack_from
+    unpackQueryID = queryIDStruct.unpack_from
+    unpackTypes = typesStruct.unpack_from
+    unpackPort = portStruct.unpack_from
+    # skips the Python-level __new__ of the named tuple
+    newRecord = tuple.__new__
+
+    while offset < end:
+        pos = offset
+        try:
+            if withTimestamps:
+                tv_sec, tv_nsec = unpackTimestamp(data, pos)
+                pos += 12
+            else:
+                tv_sec = tv_nsec = None
+
+            (queryID,) = unpackQueryID(data, pos)
+            pos += 2
+
+            qnameStart = pos
+            labelLen = data[pos]
+            while labelLen:
+                pos += labelLen + 1
+                labelLen = data[pos]
+            pos += 1
+            qname = data[qnameStart:pos]
+
+            qtype, addrType = unpackTypes(data, pos)
+            pos += 4
+            addrLen = addrLengths.get(addrType)
+            if addrLen is None:
+                raise ValueError('Unsupported address type %d at offset %d' % (int(addrType), offset))
+            addr = data[pos:pos + addrLen]
+            pos += addrLen
+            (port,) = unpackPort(data, pos)
+            pos += 2
+        except (IndexError, struct.error):
+            return
 
-    queryID = struct.unpack("!H", data)[0]
-    qname = ''
-    while True:
-        labelLen = struct.unpack("B", fp.read(1))[0]
-        if labelLen == 0:
+        if pos > end:
+            return
+
+        yield newRecord(LogActionRecord, (offset, pos - offset, tv_sec, tv_nsec, queryID, qname, qtype, addrType, addr, port))
+        offset = pos
+
+def getRecordBoundaries(data, withTimestamps, recordsPerRange, offset=0, end=None):
+    """
+    Splits the complete records of data between offset and end into ranges
+    of recordsPerRange records, walking only the record lengths. Returns the
+    list of the offsets delimiting the ranges, starting with offset and
+    ending with the end of the last complete record. Raises ValueError on an
+    unsupported address type.
+    """
+    if end is None:
+        end = len(data)
+
+    unpackType = struct.Struct("H").unpack_from
+    fixedLength = 14 if withTimestamps else 2
+    boundaries = [offset]
+    count = 0
+    while offset < end:
+        try:
+            pos = offset + fixedLength
+            labelLen = data[pos]
+            while labelLen:
+                pos += labelLen + 1
+                labelLen = data[pos]
+            pos += 3
+            (addrType,) = unpackType(data, pos)
+            addrLen = addrLengths.get(addrType)
+            if addrLen is None:
+                raise ValueError('Unsupported address type %d at offset %d' % (int(addrType), offset))
+            pos += 2 + addrLen + 2
+        except (IndexError, struct.error):
+            break
+
+        if pos > end:
             break
-        label = fp.read(labelLen)
-        if qname != '':
-            qname = qname + '.'
-        qname = qname + label.decode()
-
-    qtype = struct.unpack("H", fp.read(2))[0]
-    addrType = struct.unpack("H", fp.read(2))[0]
-    addr = None
-    if addrType == socket.AF_INET:
-        addr = socket.inet_ntop(socket.AF_INET, fp.read(4))
-    elif addrType == socket.AF_INET6:
-        addr = socket.inet_ntop(socket.AF_INET6, fp.read(16))
-    else:
-        print('Unsupported address type %d, skipping this record' % (int(addrType)))
+
+        offset = pos
+        count += 1
+        if count == recordsPerRange:
+            boundaries.append(offset)
+            count = 0
+
+    if offset != boundaries[-1]:
+        boundaries.append(offset)
+    return boundaries
+
+# the same names and clients tend to show up over and over
+@functools.lru_cache(maxsize=65536)
+def getQNameAsString(qname):
+    labels = []
+    pos = 0
+    labelLen = qname[pos]
+    while labelLen:
+        labels.append(qname[pos + 1:pos + 1 + labelLen])
+        pos += labelLen + 1
+        labelLen = qname[pos]
+    return b'.'.join(labels).decode(errors='replace')
+
+@functools.lru_cache(maxsize=65536)
+def getAddrFromBytes(addrType, addr):
+    return socket.inet_ntop(addrType, addr)
+
+def getAddrAsString(record):
+    return getAddrFromBytes(record.addrType, record.addr)
+
+def formatRecord(record):
+    addr = getAddrAsString(record)
+    qname = getQNameAsString(record.qname)
+    if record.tv_sec is not None:
+        return '[%u.%u] Packet from %s:%d for %s %s with id %d' % (record.tv_sec, record.tv_nsec, addr, record.port, qname, record.qtype, record.queryID)
+    return 'Packet from %s:%d for %s %s with id %d' % (addr, record.port, qname, record.qtype, record.queryID)
+
+def buildQuery(record):
+    return struct.pack('!HHHHHH', record.queryID, 0x0100, 1, 0, 0, 0) + bytes(record.qname) + struct.pack('!HH', record.qtype, 1)
+
+def mapLogFile(fp):
+    """
+    Returns a read-only mmap of the file, or an empty bytes object for an
+    empty file since those can not be mapped.
+    """
+    fp.seek(0, 2)
+    if fp.tell() == 0:
+        return b''
+    return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+class LogActionIndex(object):
+    """
+    Sparse timestamp index of a LogAction file written with timestamps.
+    update() only scans the records appended since the last indexed one, so
+    it can be called every time the log is read.
+    """
+
+    def __init__(self, path, interval=1000):
+        self._path = path
+        self._interval = interval
+        self._times = []
+        self._offsets = []
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self._path):
+            return
+        with open(self._path, 'rb') as fp:
+            index = fp.read()
+        if len(index) < INDEX_HEADER.size:
+            return
+        (magic, interval) = INDEX_HEADER.unpack_from(index, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError('%s is not a LogAction index' % (self._path))
+        if interval != self._interval:
+            # built with a different interval, start over
+            return
+        # ignore a partially written trailing entry
+        count = (len(index) - INDEX_HEADER.size) // INDEX_ENTRY.size
+        for idx in range(count):
+            (tv_sec, offset) = INDEX_ENTRY.unpack_from(index, INDEX_HEADER.size + idx * INDEX_ENTRY.size)
+            self._times.append(tv_sec)
+            self._offsets.append(offset)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _isLastEntryValid(self, data):
+        for record in readRecords(data, True, self._offsets[-1]):
+            return record.tv_sec == self._times[-1]
         return False
-    port = struct.unpack("!H", fp.read(2))[0]
 
-    if withTimestamp:
-        print('[%u.%u] Packet from %s:%d for %s %s with id %d' % (tv_sec, tv_nsec, addr, port, qname, qtype, queryID))
-    else:
-        print('Packet from %s:%d for %s %s with id %d' % (addr, port, qname, qtype, queryID))
+    def update(self, data):
+        """
+        Indexes the records of data (the mapped log) following the last
+        entry, and appends the new entries to the index file. Returns the
+        number of entries added.
+        """
+        if self._offsets and not self._isLastEntryValid(data):
+            # the log has been truncated or rotated
+            self._times = []
+            self._offsets = []
+
+        start = self._offsets[-1] if self._offsets else 0
+        count = -1
+        newEntries = []
+        interval = self._interval
+        for record in readRecords(data, True, start):
+            count += 1
+            if count == interval:
+                count = 0
+            if count == 0:
+                newEntries.append((record.tv_sec, record.offset))
+
+        if self._offsets:
+            # the last known entry has been seen again
+            newEntries = newEntries[1:]
+            with open(self._path, 'r+b') as fp:
+                # drop a partially written trailing entry, if any
+                fp.truncate(INDEX_HEADER.size + len(self._offsets) * INDEX_ENTRY.size)
+                fp.seek(0, 2)
+                fp.write(b''.join(INDEX_ENTRY.pack(tv_sec, offset) for tv_sec, offset in newEntries))
+        else:
+            with open(self._path, 'wb') as fp:
+                fp.write(INDEX_HEADER.pack(INDEX_MAGIC, interval))
+                fp.write(b''.join(INDEX_ENTRY.pack(tv_sec, offset) for tv_sec, offset in newEntries))
+
+        for tv_sec, offset in newEntries:
+            self._times.append(tv_sec)
+            self._offsets.append(offset)
+        return len(newEntries)
+
+    def getRange(self, fromTime=None, toTime=None):
+        """
+        Returns the (start, end) offsets of the part of the log that might
+        hold records between fromTime and toTime, end being None for the end
+        of the log. dnsdist writes records in order, give or take the ones
+        logged concurrently by different threads, so the range is widened to
+        the neighbouring entries.
+        """
+        start = 0
+        end = None
+        if fromTime is not None and self._times:
+            pos = bisect.bisect_left(self._times, fromTime)
+            if pos > 0:
+                start = self._offsets[pos - 1]
+        if toTime is not None:
+            pos = bisect.bisect_right(self._times, toTime)
+            if pos + 1 < len(self._offsets):
+                end = self._offsets[pos + 1]
+        return start, end
+
+class LogActionPcapWriter(object):
+    """
+    Writes one synthesized UDP/IP packet per record to a pcap file with
+    nanosecond timestamps and raw IP link type, so that IPv4 and IPv6
+    packets can be mixed. Records without timestamps are dated at the epoch.
+    """
+
+    LINKTYPE_RAW = 101
+
+    def __init__(self, path, destination4, destination6, destinationPort):
+        self._fp = open(path, 'wb', buffering=1024 * 1024)
+        self._destinations = {socket.AF_INET: socket.inet_pton(socket.AF_INET, destination4),
+                              socket.AF_INET6: socket.inet_pton(socket.AF_INET6, destination6)}
+        self._destinationPort = destinationPort
+        self._fp.write(struct.pack('<IHHiIII', 0xa1b23c4d, 2, 4, 0, 0, 65535, self.LINKTYPE_RAW))
+
+    def close(self):
+        self._fp.close()
+
+    @staticmethod
+    def getChecksum(data):
+        if len(data) % 2:
+            data += b'\0'
+        total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+        while total > 0xffff:
+            total = (total & 0xffff) + (total >> 16)
+        return ~total & 0xffff
 
-    return True
+    def getPacket(self, record):
+        payload = buildQuery(record)
+        source = bytes(record.addr)
+        destination = self._destinations[record.addrType]
+        udpLength = 8 + len(payload)
+        if record.addrType == socket.AF_INET:
+            pseudoHeader = source + destination + struct.pack('!BBH', 0, socket.IPPROTO_UDP, udpLength)
+        else:
+            pseudoHeader = source + destination + struct.pack('!IxxxB', udpLength, socket.IPPROTO_UDP)
+        udpHeader = struct.pack('!HHHH', record.port, self._destinationPort, udpLength, 0)
+        checksum = self.getChecksum(pseudoHeader + udpHeader + payload) or 0xffff
+        udp = struct.pack('!HHHH', record.port, self._destinationPort, udpLength, checksum) + payload
 
-def readLogFile(filename, withTimestamps):
+        if record.addrType == socket.AF_INET:
+            ipHeader = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(udp), 0, 0x4000, 64, socket.IPPROTO_UDP, 0, source, destination)
+            ipHeader = ipHeader[:10] + struct.pack('!H', self.getChecksum(ipHeader)) + ipHeader[12:]
+        else:
+            ipHeader = struct.pack('!IHBB16s16s', 6 << 28, len(udp), socket.IPPROTO_UDP, 64, source, destination)
+        return ipHeader + udp
+
+    def write(self, record):
+        packet = self.getPacket(record)
+        self._fp.write(struct.pack('<IIII', record.tv_sec or 0, record.tv_nsec or 0, len(packet), len(packet)))
+        self._fp.write(packet)
+
+class LogActionDnstapWriter(object):
+    """
+    Writes one CLIENT_QUERY dnstap message per record to a frame streams
+    file, as read by fstrm_capture or dnstap-read.
+    """
+
+    CONTENT_TYPE = b'protobuf:dnstap.Dnstap'
+    FSTRM_CONTROL_START = 0x02
+    FSTRM_CONTROL_STOP = 0x03
+    FSTRM_CONTROL_FIELD_CONTENT_TYPE = 0x01
+
+    def __init__(self, path, destination4, destination6, destinationPort, identity):
+        # run: protoc -I=../pdns/ --python_out=. ../pdns/dnstap.proto
+        # to generate dnstap_pb2
+        import dnstap_pb2
+        self._dnstap_pb2 = dnstap_pb2
+        self._fp = open(path, 'wb', buffering=1024 * 1024)
+        self._destinations = {socket.AF_INET: socket.inet_pton(socket.AF_INET, destination4),
+                              socket.AF_INET6: socket.inet_pton(socket.AF_INET6, destination6)}
+        self._destinationPort = destinationPort
+        self._identity = identity
+        self.writeControlFrame(struct.pack('!III', self.FSTRM_CONTROL_START, self.FSTRM_CONTROL_FIELD_CONTENT_TYPE, len(self.CONTENT_TYPE)) + self.CONTENT_TYPE)
+
+    def writeControlFrame(self, frame):
+        self._fp.write(struct.pack('!II', 0, len(frame)) + frame)
+
+    def close(self):
+        self.writeControlFrame(struct.pack('!I', self.FSTRM_CONTROL_STOP))
+        self._fp.close()
+
+    def write(self, record):
+        dnstap_pb2 = self._dnstap_pb2
+        dnstap = dnstap_pb2.Dnstap()
+        dnstap.type = dnstap_pb2.Dnstap.MESSAGE
+        if self._identity:
+            dnstap.identity = self._identity
+        message = dnstap.message
+        message.type = dnstap_pb2.Message.CLIENT_QUERY
+        message.socket_family = dnstap_pb2.INET if record.addrType == socket.AF_INET else dnstap_pb2.INET6
+        message.socket_protocol = dnstap_pb2.UDP
+        message.query_address = bytes(record.addr)
+        message.query_port = record.port
+        message.response_address = self._destinations[record.addrType]
+        message.response_port = self._destinationPort
+        if record.tv_sec is not None:
+            message.query_time_sec = record.tv_sec
+            message.query_time_nsec = record.tv_nsec
+        message.query_message = buildQuery(record)
+
+        data = dnstap.SerializeToString()
+        self._fp.write(struct.pack('!I', len(data)))
+        self._fp.write(data)
+
+class LogActionAggregator(object):
+    """
+    Running counters per source address, qname and qtype. Keys are kept in
+    their raw form, the address and wire qname bytes, and only converted to
+    strings for the reported entries.
+    """
+
+    dimensions = ('source', 'qname', 'qtype')
+
+    def __init__(self):
+        self.records = 0
+        self._lastRecords = 0
+        self._lastReport = time.monotonic()
+        self._counters = dict((dimension, {}) for dimension in self.dimensions)
+
+    def addRecord(self, record):
+        counters = self._counters
+        sources = counters['source']
+        qnames = counters['qname']
+        qtypes = counters['qtype']
+        sources[record.addr] = sources.get(record.addr, 0) + 1
+        qnames[record.qname] = qnames.get(record.qname, 0) + 1
+        qtypes[record.qtype] = qtypes.get(record.qtype, 0) + 1
+        self.records += 1
+
+    def merge(self, other):
+        for dimension in self.dimensions:
+            counters = self._counters[dimension]
+            for key, count in other._counters[dimension].items():
+                counters[key] = counters.get(key, 0) + count
+        self.records += other.records
+
+    @staticmethod
+    def getKeyAsString(dimension, key):
+        if dimension == 'source':
+            return getAddrFromBytes(socket.AF_INET if len(key) == 4 else socket.AF_INET6, key)
+        if dimension == 'qname':
+            return getQNameAsString(key)
+        return str(key)
+
+    def getTop(self, dimension, top):
+        counters = self._counters[dimension]
+        # ties are broken on the key, the counters being merged in no particular order
+        return [(self.getKeyAsString(dimension, key), count) for key, count in heapq.nsmallest(top, counters.items(), key=lambda item: (-item[1], item[0]))]
+
+    def report(self, top):
+        now = time.monotonic()
+        elapsed = now - self._lastReport
+        recent = self.records - self._lastRecords
+        self._lastReport = now
+        self._lastRecords = self.records
+
+        datestr = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        print('[%s] Top %d over %d records (%d in the last %ds):' % (datestr, top, self.records, recent, elapsed))
+        if not self.records:
+            return
+        for dimension in self.dimensions:
+            print('- %s:' % (dimension))
+            for value, count in self.getTop(dimension, top):
+                print('\t- %d (%.1f%%) %s' % (count, 100.0 * count / self.records, value))
+
+def readLogFile(filename, withTimestamps, fromTime=None, toTime=None, indexInterval=1000, aggregator=None, writer=None):
     with open(filename, mode='rb') as fp:
+        data = mapLogFile(fp)
+        try:
+            start = 0
+            end = None
+            if fromTime is not None or toTime is not None:
+                index = LogActionIndex(filename + '.idx', indexInterval)
+                index.update(data)
+                (start, end) = index.getRange(fromTime, toTime)
+
+            for record in readRecords(data, withTimestamps, start, end):
+                if fromTime is not None and record.tv_sec < fromTime:
+                    continue
+                if toTime is not None and record.tv_sec > toTime:
+                    continue
+                if aggregator:
+                    aggregator.addRecord(record)
+                elif writer:
+                    writer.write(record)
+                else:
+                    print(formatRecord(record))
+        except ValueError as exp:
+            print('%s, skipping the remaining records' % (str(exp)))
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+def aggregateRange(filename, withTimestamps, start, end, fromTime, toTime):
+    """
+    Runs in a worker process, returns the counters of the records between
+    the start and end offsets.
+    """
+    aggregator = LogActionAggregator()
+    with open(filename, mode='rb') as fp:
+        data = mapLogFile(fp)
+        try:
+            for record in readRecords(data, withTimestamps, start, end):
+                if fromTime is not None and record.tv_sec < fromTime:
+                    continue
+                if toTime is not None and record.tv_sec > toTime:
+                    continue
+                aggregator.addRecord(record)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    return aggregator
+
+def aggregateRangeTask(task):
+    return aggregateRange(*task)
+
+def aggregateLogFileInParallel(filename, withTimestamps, aggregator, workers, recordsPerRange, fromTime=None, toTime=None, indexInterval=1000):
+    """
+    The records are not self-delimiting, so a first sequential pass finds
+    the boundaries of ranges of recordsPerRange records, then the ranges are
+    aggregated by a pool of worker processes and their counters merged as
+    soon as they are received, so that only a few of them are held at once.
+    """
+    with open(filename, mode='rb') as fp:
+        data = mapLogFile(fp)
+        try:
+            start = 0
+            end = None
+            if fromTime is not None or toTime is not None:
+                index = LogActionIndex(filename + '.idx', indexInterval)
+                index.update(data)
+                (start, end) = index.getRange(fromTime, toTime)
+            boundaries = getRecordBoundaries(data, withTimestamps, recordsPerRange, start, end)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    tasks = [(filename, withTimestamps, rangeStart, rangeEnd, fromTime, toTime) for rangeStart, rangeEnd in zip(boundaries, boundaries[1:])]
+    with multiprocessing.Pool(workers) as pool:
+        for partial in pool.imap_unordered(aggregateRangeTask, tasks, chunksize=1):
+            aggregator.merge(partial)
+
+def getFollowStart(fp, filename, withTimestamps, indexInterval):
+    """
+    Returns the offset following the last complete record of the log, using
+    the index to skip most of the existing records if there is one.
+    """
+    data = mapLogFile(fp)
+    try:
+        start = 0
+        if withTimestamps and os.path.exists(filename + '.idx'):
+            index = LogActionIndex(filename + '.idx', indexInterval)
+            index.update(data)
+            (start, _) = index.getRange(fromTime=sys.maxsize)
+        for record in readRecords(data, withTimestamps, start):
+            start = record.offset + record.length
+        return start
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+def followLogFile(filename, withTimestamps, aggregator=None, reportInterval=10, top=10, indexInterval=1000, pollInterval=0.2):
+    """
+    Prints (or aggregates) the records as they are appended to the log,
+    like tail -f. A partial record at the end of the log is kept until the
+    remaining of it has been written. The log is reopened from the start
+    when it is rotated or truncated.
+    """
+    fp = open(filename, mode='rb')
+    fp.seek(getFollowStart(fp, filename, withTimestamps, indexInterval))
+    pending = b''
+    nextReport = time.monotonic() + reportInterval
+    try:
         while True:
-            if not readRecord(fp, withTimestamps):
-                break
+            chunk = fp.read(1024 * 1024)
+            if chunk:
+                pending = pending + chunk if pending else chunk
+                consumed = 0
+                for record in readRecords(pending, withTimestamps):
+                    if aggregator:
+                        aggregator.addRecord(record)
+                    else:
+                        print(formatRecord(record))
+                    consumed = record.offset + record.length
+                pending = pending[consumed:]
+            else:
+                try:
+                    st = os.stat(filename)
+                    if st.st_ino != os.fstat(fp.fileno()).st_ino or st.st_size < fp.tell():
+                        fp.close()
+                        fp = open(filename, mode='rb')
+                        pending = b''
+                except FileNotFoundError:
+                    # rotated, but not yet recreated
+                    pass
+                time.sleep(pollInterval)
+
+            if aggregator and time.monotonic() >= nextReport:
+                aggregator.report(top)
+                nextReport = time.monotonic() + reportInterval
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fp.close()
+
+def buildIndex(filename, indexInterval):
+    with open(filename, mode='rb') as fp:
+        data = mapLogFile(fp)
+        try:
+            index = LogActionIndex(filename + '.idx', indexInterval)
+            added = index.update(data)
+            print('Added %d entries to %s.idx, %d in total' % (added, filename, len(index)))
+        except ValueError as exp:
+            print('%s, the index stops there' % (str(exp)))
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+def parseTime(value):
+    try:
+        return int(value)
+    except ValueError:
+        return int(datetime.datetime.fromisoformat(value).timestamp())
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2 and (len(sys.argv) != 3 or sys.argv[2] != 'with-timestamps'):
-        sys.exit('Usage: %s <path to log file> [with-timestamps]' % (sys.argv[0]))
+    parser = argparse.ArgumentParser(description='Read the binary files written by dnsdist\'s LogAction')
+    parser.add_argument('path', help='Path to the log file')
+    parser.add_argument('timestamps', nargs='?', choices=['with-timestamps'],
+                        help='The file has been written with timestamps')
+    parser.add_argument('--from', dest='fromTime', type=parseTime,
+                        help='Only print the records logged at or after that time (epoch or ISO 8601), using the index')
+    parser.add_argument('--to', dest='toTime', type=parseTime,
+                        help='Only print the records logged at or before that time (epoch or ISO 8601), using the index')
+    parser.add_argument('--build-index', action='store_true',
+                        help='Create or update the timestamp index, <path>.idx, then exit')
+    parser.add_argument('--index-interval', type=int, default=1000,
+                        help='Number of records between two entries of the index (default: %(default)s)')
+    parser.add_argument('--follow', action='store_true',
+                        help='Wait for new records to be appended to the file, like tail -f')
+    parser.add_argument('--aggregate', action='store_true',
+                        help='Instead of printing the records, report the most frequent source addresses, qnames and qtypes')
+    parser.add_argument('--top', type=int, default=10,
+                        help='Number of entries to report per counter with --aggregate (default: %(default)s)')
+    parser.add_argument('--report-interval', type=int, default=10,
+                        help='Interval between two reports with --aggregate --follow, in seconds (default: %(default)s)')
+    parser.add_argument('--pcap', help='Instead of printing the records, write them as synthesized UDP/IP queries to that pcap file')
+    parser.add_argument('--dnstap', help='Instead of printing the records, write them as dnstap CLIENT_QUERY messages to that frame streams file')
+    parser.add_argument('--destination', default='127.0.0.1',
+                        help='Destination address of the converted IPv4 queries (default: %(default)s)')
+    parser.add_argument('--destination6', default='::1',
+                        help='Destination address of the converted IPv6 queries (default: %(default)s)')
+    parser.add_argument('--destination-port', type=int, default=53,
+                        help='Destination port of the converted queries (default: %(default)s)')
+    parser.add_argument('--identity', help='Identity of the converted dnstap messages')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Number of worker processes used to aggregate ranges of the file in parallel, 0 to process it sequentially (default: %(default)s)')
+    parser.add_argument('--range-records', type=int, default=100000,
+                        help='Number of records handed to a worker at once with --workers (default: %(default)s)')
+    args = parser.parse_args()
+
+    withTimestamps = args.timestamps is not None
+    if (args.build_index or args.fromTime is not None or args.toTime is not None) and not withTimestamps:
+        sys.exit('The timestamp index requires a file written with timestamps')
+
+    if args.follow and (args.fromTime is not None or args.toTime is not None):
+        sys.exit('--follow can not be combined with --from and --to')
+    if args.workers and (not args.aggregate or args.follow):
+        sys.exit('--workers requires --aggregate and can not be combined with --follow')
+    if (args.pcap or args.dnstap) and (args.aggregate or args.follow or (args.pcap and args.dnstap)):
+        sys.exit('--pcap and --dnstap are exclusive and can not be combined with --aggregate or --follow')
+
+    aggregator = LogActionAggregator() if args.aggregate else None
+    writer = None
+    try:
+        if args.pcap:
+            writer = LogActionPcapWriter(args.pcap, args.destination, args.destination6, args.destination_port)
+        elif args.dnstap:
+            writer = LogActionDnstapWriter(args.dnstap, args.destination, args.destination6, args.destination_port,
+                                           args.identity.encode() if args.identity else None)
+
+        if args.build_index:
+            buildIndex(args.path, args.index_interval)
+        elif args.workers:
+            aggregateLogFileInParallel(args.path, withTimestamps, aggregator, args.workers, args.range_records, args.fromTime, args.toTime, args.index_interval)
+        elif args.follow:
+            followLogFile(args.path, withTimestamps, aggregator, args.report_interval, args.top, args.index_interval)
+        else:
+            readLogFile(args.path, withTimestamps, args.fromTime, args.toTime, args.index_interval, aggregator, writer)
+    except (OSError, ValueError) as exp:
+        sys.exit(str(exp))
+    finally:
+        if writer:
+            writer.close()
 
-    readLogFile(sys.argv[1], len(sys.argv) == 3)
+    if aggregator:
+        aggregator.report(args.top)
 
     sys.exit(0)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Compares the speed of the previous, read()-based, LogAction reader with the
+# mmap-based one of DNSDistLogActionReader.py on a generated file.
+
+import argparse
+import os
+import random
+import socket
+import struct
+import sys
+import time
+
+import DNSDistLogActionReader
+
+def generateLogFile(filename, records, withTimestamps):
+    """
+    Writes records entries the way dnsdist's LogAction(binary=true) does:
+    native byte order except for the query ID and the port.
+    """
+    rng = random.Random(42)
+    names = []
+    for idx in range(10000):
+        labels = ['www', 'name%d' % (idx), rng.choice(['com', 'net', 'org', 'example'])]
+        names.append(b''.join(struct.pack('B', len(label)) + label.encode() for label in labels) + b'\0')
+    addresses = [struct.pack('H', socket.AF_INET) + socket.inet_pton(socket.AF_INET, '192.0.2.%d' % (idx)) for idx in range(1, 255)]
+    addresses += [struct.pack('H', socket.AF_INET6) + socket.inet_pton(socket.AF_INET6, '2001:db8::%x' % (idx)) for idx in range(1, 255)]
+
+    now = int(time.time())
+    with open(filename, 'wb', buffering=1024 * 1024) as fp:
+        for idx in range(records):
+            if withTimestamps:
+                fp.write(struct.pack('QI', now + idx // 10000, (idx % 10000) * 100000))
+            fp.write(struct.pack('!H', idx & 0xffff))
+            fp.write(rng.choice(names))
+            fp.write(struct.pack('H', rng.choice((1, 28, 15, 16))))
+            fp.write(rng.choice(addresses))
+            fp.write(struct.pack('!H', rng.randrange(1024, 65536)))
+
+def legacyReadRecord(fp, withTimestamp):
+    """
+    The previous reader, minus the printing.
+    """
+    if withTimestamp:
+        data = fp.read(12)
+        if not data:
+            return False
+        tv_sec, tv_nsec = struct.unpack("QI", data)
+
+    data = fp.read(2)
+    if not data:
+        return False
+
+    queryID = struct.unpack("!H", data)[0]
+    qname = ''
+    while True:
+        labelLen = struct.unpack("B", fp.read(1))[0]
+        if labelLen == 0:
+            break
+        label = fp.read(labelLen)
+        if qname != '':
+            qname = qname + '.'
+        qname = qname + label.decode()
+
+    qtype = struct.unpack("H", fp.read(2))[0]
+    addrType = struct.unpack("H", fp.read(2))[0]
+    addr = None
+    if addrType == socket.AF_INET:
+        addr = socket.inet_ntop(socket.AF_INET, fp.read(4))
+    elif addrType == socket.AF_INET6:
+        addr = socket.inet_ntop(socket.AF_INET6, fp.read(16))
+    else:
+        return False
+    port = struct.unpack("!H", fp.read(2))[0]
+    return True
+
+def benchmarkLegacy(filename, withTimestamps):
+    count = 0
+    with open(filename, mode='rb') as fp:
+        while legacyReadRecord(fp, withTimestamps):
+            count += 1
+    return count
+
+def benchmarkMmap(filename, withTimestamps):
+    count = 0
+    with open(filename, mode='rb') as fp:
+        data = DNSDistLogActionReader.mapLogFile(fp)
+        for record in DNSDistLogActionReader.readRecords(data, withTimestamps):
+            count += 1
+        data.close()
+    return count
+
+def benchmarkMmapFormatted(filename, withTimestamps):
+    """
+    Also converts the qname and address to strings, as the legacy reader does.
+    """
+    count = 0
+    with open(filename, mode='rb') as fp:
+        data = DNSDistLogActionReader.mapLogFile(fp)
+        for record in DNSDistLogActionReader.readRecords(data, withTimestamps):
+            DNSDistLogActionReader.getQNameAsString(record.qname)
+            DNSDistLogActionReader.getAddrAsString(record)
+            count += 1
+        data.close()
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the LogAction readers of DNSDistLogActionReader.py')
+    parser.add_argument('--records', type=int, default=10000000,
+                        help='Number of records of the generated file (default: %(default)s)')
+    parser.add_argument('--file', default='logaction-benchmark.bin',
+                        help='Generated file, kept if it already exists (default: %(default)s)')
+    parser.add_argument('--with-timestamps', action='store_true',
+                        help='Generate and read records with timestamps')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.file):
+        print('Generating %d records into %s' % (args.records, args.file))
+        generateLogFile(args.file, args.records, args.with_timestamps)
+
+    size = os.path.getsize(args.file)
+    for name, reader in (('legacy', benchmarkLegacy), ('mmap', benchmarkMmap), ('mmap + strings', benchmarkMmapFormatted)):
+        start = time.monotonic()
+        count = reader(args.file, args.with_timestamps)
+        elapsed = time.monotonic() - start
+        print('%s: %d records (%d bytes) in %.2fs, %.0f records/s' % (name, count, size, elapsed, count / elapsed))
+
+    sys.exit(0)
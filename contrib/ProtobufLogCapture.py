@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# Capture files of the raw protobuf streams received by ProtobufLogger.py
+# (see its --capture option), and a replayer pushing them to a collector.
+#
+# A capture is made of two files:
+# - the capture itself, holding the frames (16-bit network byte order
+#   length followed by the serialized PBDNSMessage) exactly as received;
+# - an index, <capture>.idx, holding a magic followed, for every frame, by
+#   its offset in the capture and its arrival time in nanoseconds since the
+#   epoch, both as little-endian 64-bit integers.
+
+import argparse
+import mmap
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+INDEX_MAGIC = b'PDNSPBI1'
+INDEX_ENTRY = struct.Struct('<QQ')
+
+class PDNSPBCaptureWriter(object):
+    """
+    Appends frames to a capture and its index. write() might be called from
+    several connection threads at once.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._fp = None
+        self._indexFp = None
+        self._offset = 0
+
+    def open(self):
+        self._fp = open(self._path, 'wb', buffering=1024 * 1024)
+        self._indexFp = open(self._path + '.idx', 'wb', buffering=1024 * 1024)
+        self._indexFp.write(INDEX_MAGIC)
+        self._offset = 0
+
+    def close(self):
+        with self._lock:
+            if self._fp:
+                self._fp.close()
+                self._indexFp.close()
+                self._fp = None
+                self._indexFp = None
+
+    def write(self, data):
+        arrival = time.time_ns()
+        with self._lock:
+            if self._fp is None:
+                return
+            self._fp.write(struct.pack('!H', len(data)))
+            self._fp.write(data)
+            self._indexFp.write(INDEX_ENTRY.pack(self._offset, arrival))
+            self._offset += 2 + len(data)
+
+class PDNSPBCaptureReader(object):
+    """
+    Memory-maps a capture and its index, if any. Without an index, frames
+    are found by walking the length prefixes and have no arrival time.
+    """
+
+    def __init__(self, path):
+        self._fp = open(path, 'rb')
+        self._size = os.fstat(self._fp.fileno()).st_size
+        self._mmap = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ) if self._size else b''
+        self._index = None
+        indexPath = path + '.idx'
+        if os.path.exists(indexPath):
+            with open(indexPath, 'rb') as fp:
+                index = fp.read()
+            if index[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+                raise ValueError('%s is not a capture index' % (indexPath))
+            # ignore a partially written trailing entry
+            count = (len(index) - len(INDEX_MAGIC)) // INDEX_ENTRY.size
+            self._index = [INDEX_ENTRY.unpack_from(index, len(INDEX_MAGIC) + idx * INDEX_ENTRY.size) for idx in range(count)]
+
+    def close(self):
+        if self._size:
+            self._mmap.close()
+        self._fp.close()
+
+    def hasTimestamps(self):
+        return self._index is not None
+
+    def getFrames(self, skip=0, count=None):
+        """
+        Yields (offset, length including the prefix, arrival time in ns or
+        None) for every complete frame.
+        """
+        if self._index is not None:
+            entries = self._index[skip:] if count is None else self._index[skip:skip + count]
+            for offset, arrival in entries:
+                if offset + 2 > self._size:
+                    break
+                (datalen,) = struct.unpack_from('!H', self._mmap, offset)
+                if offset + 2 + datalen > self._size:
+                    break
+                yield offset, 2 + datalen, arrival
+            return
+
+        offset = 0
+        idx = 0
+        while offset + 2 <= self._size and (count is None or idx < skip + count):
+            (datalen,) = struct.unpack_from('!H', self._mmap, offset)
+            if offset + 2 + datalen > self._size:
+                break
+            if idx >= skip:
+                yield offset, 2 + datalen, None
+            offset += 2 + datalen
+            idx += 1
+
+    def getData(self, offset, length):
+        return self._mmap[offset:offset + length]
+
+def replay(reader, sock, speed, skip, count, batchSize):
+    """
+    Sends the frames over sock, paced on their arrival times divided by
+    speed, or as fast as possible if speed is 0 or the capture has no index.
+    Frames are sent by batches of up to batchSize bytes.
+    """
+    frames = 0
+    pending = []
+    pendingSize = 0
+    startTime = None
+    firstArrival = None
+
+    for offset, length, arrival in reader.getFrames(skip, count):
+        if speed > 0 and arrival is not None:
+            if startTime is None:
+                startTime = time.monotonic()
+                firstArrival = arrival
+            due = startTime + (arrival - firstArrival) / 1e9 / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                if pending:
+                    sock.sendall(b''.join(pending))
+                    pending = []
+                    pendingSize = 0
+                time.sleep(delay)
+
+        pending.append(reader.getData(offset, length))
+        pendingSize += length
+        frames += 1
+        if pendingSize >= batchSize:
+            sock.sendall(b''.join(pending))
+            pending = []
+            pendingSize = 0
+
+    if pending:
+        sock.sendall(b''.join(pending))
+    return frames
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay a capture made by ProtobufLogger.py --capture to a collector')
+    parser.add_argument('capture', help='Capture file')
+    parser.add_argument('address', help='Address of the collector')
+    parser.add_argument('port', type=int, help='Port of the collector')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Replay speed relative to the capture, 0 meaning as fast as possible (default: %(default)s)')
+    parser.add_argument('--skip', type=int, default=0, help='Number of frames to skip at the beginning of the capture')
+    parser.add_argument('--count', type=int, help='Number of frames to replay')
+    parser.add_argument('--batch-size', type=int, default=65536,
+                        help='Maximum number of bytes sent at once (default: %(default)s)')
+    args = parser.parse_args()
+
+    reader = PDNSPBCaptureReader(args.capture)
+    if args.speed > 0 and not reader.hasTimestamps():
+        print('No index found for %s, replaying as fast as possible' % (args.capture))
+
+    try:
+        sock = socket.create_connection((args.address, args.port))
+    except socket.error as exp:
+        sys.exit('Error connecting to %s:%d: %s' % (args.address, args.port, str(exp)))
+
+    start = time.monotonic()
+    frames = replay(reader, sock, args.speed, args.skip, args.count, args.batch_size)
+    elapsed = time.monotonic() - start
+    sock.close()
+    reader.close()
+
+    print('Replayed %d frames in %.2fs (%.0f frames/s)' % (frames, elapsed, frames / elapsed if elapsed > 0 else 0))
+    sys.exit(0)
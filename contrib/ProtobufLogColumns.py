@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+# Columnar storage for the protobuf messages received by ProtobufLogger.py
+# (see its --columnar-dir option), and a reader to query the chunk files.
+#
+# A chunk file holds a batch of messages, stored column by column so that
+# scanning one field only touches the bytes of that field:
+# - a header: magic, number of rows, number of columns, lowest and highest
+#   timeSec of the chunk, so that time range queries can skip whole chunks;
+# - one directory entry per column: name, array typecode, number of values
+#   per row, offset and length of the column data;
+# - the column data, little-endian, each column aligned on 8 bytes.
+# String columns (typecode 's') hold rows + 1 uint32 offsets into the UTF-8
+# data that follows them.
+
+import argparse
+import array
+import collections
+import datetime
+import mmap
+import os
+import socket
+import struct
+import sys
+
+MAGIC = b'PDNSPBC1'
+HEADER = struct.Struct('<8sIIII')
+COLUMN = struct.Struct('<16scBHQQ')
+
+# no response code, for queries
+NO_RCODE = 0xFFFFFFFF
+# latency unknown, for queries and responses without the query time
+NO_LATENCY = -1
+
+# name, typecode, values per row
+FIXED_COLUMNS = [
+    ('timeSec', 'I', 1),
+    ('timeUsec', 'I', 1),
+    ('type', 'B', 1),
+    ('family', 'B', 1),
+    ('protocol', 'B', 1),
+    ('from', 'B', 16),
+    ('fromPort', 'H', 1),
+    ('to', 'B', 16),
+    ('toPort', 'H', 1),
+    ('qtype', 'H', 1),
+    ('rcode', 'I', 1),
+    ('latency', 'q', 1),
+    ('policyType', 'B', 1),
+]
+STRING_COLUMNS = ['qname', 'policy', 'tags', 'serverIdentity']
+
+TYPES = {1: 'Query', 2: 'Response', 3: 'Query (O)', 4: 'Response (I)'}
+
+class PDNSPBColumnChunkBuilder(object):
+    """
+    Accumulates messages into in-memory arrays, one per column, until the
+    chunk is written to disk.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.minTime = None
+        self.maxTime = None
+        self._columns = dict((name, array.array(typecode)) for name, typecode, _ in FIXED_COLUMNS)
+        self._strings = dict((name, (array.array('I', [0]), bytearray())) for name in STRING_COLUMNS)
+
+    def addString(self, name, value):
+        (offsets, data) = self._strings[name]
+        data.extend(value)
+        offsets.append(len(data))
+
+    def appendMessage(self, msg):
+        columns = self._columns
+        timeSec = msg.timeSec
+        columns['timeSec'].append(timeSec)
+        columns['timeUsec'].append(msg.timeUsec)
+        columns['type'].append(msg.type)
+        columns['family'].append(msg.socketFamily)
+        columns['protocol'].append(msg.socketProtocol)
+        columns['from'].frombytes(getattr(msg, 'from').ljust(16, b'\0'))
+        columns['fromPort'].append(msg.fromPort)
+        columns['to'].frombytes(msg.to.ljust(16, b'\0'))
+        columns['toPort'].append(msg.toPort)
+        columns['qtype'].append(msg.question.qType)
+
+        rcode = NO_RCODE
+        latency = NO_LATENCY
+        policy = b''
+        policyType = 0
+        tags = b''
+        if msg.HasField('response'):
+            response = msg.response
+            rcode = response.rcode
+            if response.HasField('queryTimeSec'):
+                latency = (timeSec - response.queryTimeSec) * 1000000 + msg.timeUsec - response.queryTimeUsec
+            if response.appliedPolicy:
+                policy = response.appliedPolicy.encode()
+                policyType = response.appliedPolicyType
+            if response.tags:
+                tags = ','.join(response.tags).encode()
+        columns['rcode'].append(rcode)
+        columns['latency'].append(latency)
+        columns['policyType'].append(policyType)
+
+        self.addString('qname', msg.question.qName.encode())
+        self.addString('policy', policy)
+        self.addString('tags', tags)
+        self.addString('serverIdentity', msg.serverIdentity)
+
+        if self.minTime is None or timeSec < self.minTime:
+            self.minTime = timeSec
+        if self.maxTime is None or timeSec > self.maxTime:
+            self.maxTime = timeSec
+        self.rows += 1
+
+    def getColumnsData(self):
+        for name, typecode, width in FIXED_COLUMNS:
+            values = self._columns[name]
+            if sys.byteorder != 'little' and values.itemsize > 1:
+                values = array.array(typecode, values)
+                values.byteswap()
+            yield name, typecode, width, values.tobytes()
+        for name in STRING_COLUMNS:
+            (offsets, data) = self._strings[name]
+            if sys.byteorder != 'little':
+                offsets = array.array('I', offsets)
+                offsets.byteswap()
+            yield name, 's', 1, offsets.tobytes() + data
+
+    def write(self, path):
+        """
+        Writes the chunk to a temporary file renamed into place once
+        complete, so readers never see a partial chunk.
+        """
+        columns = list(self.getColumnsData())
+        offset = HEADER.size + COLUMN.size * len(columns)
+        directory = []
+        for name, typecode, width, data in columns:
+            offset = (offset + 7) & ~7
+            directory.append(COLUMN.pack(name.encode(), typecode.encode(), width, 0, offset, len(data)))
+            offset += len(data)
+
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'wb') as fp:
+            fp.write(HEADER.pack(MAGIC, self.rows, len(columns), self.minTime or 0, self.maxTime or 0))
+            for entry in directory:
+                fp.write(entry)
+            for _, _, _, data in columns:
+                fp.write(b'\0' * (-fp.tell() % 8))
+                fp.write(data)
+        os.rename(tmpPath, path)
+
+class PDNSPBColumnChunk(object):
+    """
+    Memory-maps a chunk file. Fixed-size columns are exposed as memoryviews
+    of the mapping, so nothing is copied or decoded until it is accessed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        # every view of the mapping has to be released before closing it
+        self._views = []
+        (magic, self.rows, count, self.minTime, self.maxTime) = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a protobuf log chunk' % (path))
+
+        self._columns = {}
+        self._widths = {}
+        self._strings = {}
+        for idx in range(count):
+            (name, typecode, width, _, offset, length) = COLUMN.unpack_from(self._mmap, HEADER.size + idx * COLUMN.size)
+            name = name.rstrip(b'\0').decode()
+            typecode = typecode.decode()
+            if typecode == 's':
+                offsetsLength = (self.rows + 1) * 4
+                self._strings[name] = (self.getArray('I', offset, offsetsLength),
+                                       self.getArray('B', offset + offsetsLength, length - offsetsLength))
+            else:
+                self._columns[name] = self.getArray(typecode, offset, length)
+                self._widths[name] = width
+
+    def getArray(self, typecode, offset, length):
+        view = self._view[offset:offset + length]
+        self._views.append(view)
+        if sys.byteorder == 'little' or typecode == 'B':
+            view = view.cast(typecode)
+            self._views.append(view)
+            return view
+        values = array.array(typecode, view.tobytes())
+        values.byteswap()
+        return values
+
+    def close(self):
+        self._columns = {}
+        self._strings = {}
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._view.release()
+        self._mmap.close()
+
+    def __len__(self):
+        return self.rows
+
+    def getColumn(self, name):
+        return self._columns[name]
+
+    def getValue(self, name, row):
+        if name in self._strings:
+            return self.getString(name, row)
+        width = self._widths[name]
+        if width == 1:
+            return self._columns[name][row]
+        return bytes(self._columns[name][row * width:(row + 1) * width])
+
+    def getString(self, name, row):
+        (offsets, data) = self._strings[name]
+        return bytes(data[offsets[row]:offsets[row + 1]]).decode(errors='replace')
+
+    def getAddress(self, name, row):
+        value = self.getValue(name, row)
+        if self._columns['family'][row] == 1:
+            return socket.inet_ntop(socket.AF_INET, value[:4])
+        return socket.inet_ntop(socket.AF_INET6, value)
+
+    def getRows(self, fromTime=None, toTime=None):
+        if (fromTime is not None and self.maxTime < fromTime) or (toTime is not None and self.minTime > toTime):
+            return
+        times = self._columns['timeSec']
+        for row in range(self.rows):
+            if fromTime is not None and times[row] < fromTime:
+                continue
+            if toTime is not None and times[row] > toTime:
+                continue
+            yield row
+
+def listChunkFiles(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith('.pbc'):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+def parseTime(value):
+    try:
+        return int(value)
+    except ValueError:
+        return int(datetime.datetime.fromisoformat(value).timestamp())
+
+def printRow(chunk, row):
+    datestr = datetime.datetime.fromtimestamp(chunk.getValue('timeSec', row)).strftime('%Y-%m-%d %H:%M:%S')
+    rcode = chunk.getValue('rcode', row)
+    latency = chunk.getValue('latency', row)
+    print('[%s.%d] %s %s:%d -> %s:%d %s %d rcode: %s latency: %s policy: %s tags: %s serverid: %s' % (datestr,
+                                                                                                     chunk.getValue('timeUsec', row),
+                                                                                                     TYPES.get(chunk.getValue('type', row), 'N/A'),
+                                                                                                     chunk.getAddress('from', row),
+                                                                                                     chunk.getValue('fromPort', row),
+                                                                                                     chunk.getAddress('to', row),
+                                                                                                     chunk.getValue('toPort', row),
+                                                                                                     chunk.getString('qname', row),
+                                                                                                     chunk.getValue('qtype', row),
+                                                                                                     'N/A' if rcode == NO_RCODE else rcode,
+                                                                                                     'N/A' if latency == NO_LATENCY else '%dus' % (latency),
+                                                                                                     chunk.getString('policy', row) or 'N/A',
+                                                                                                     chunk.getString('tags', row) or 'N/A',
+                                                                                                     chunk.getString('serverIdentity', row) or 'N/A'))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Query the columnar protobuf logs written by ProtobufLogger.py')
+    parser.add_argument('paths', nargs='+', help='Chunk files, or directories containing them')
+    parser.add_argument('--from', dest='fromTime', type=parseTime, help='Only consider messages received at or after that time (epoch or ISO 8601)')
+    parser.add_argument('--to', dest='toTime', type=parseTime, help='Only consider messages received at or before that time (epoch or ISO 8601)')
+    parser.add_argument('--qname', help='Only consider messages for that name or its sub-domains')
+    parser.add_argument('--qtype', type=int, help='Only consider messages for that query type')
+    parser.add_argument('--rcode', type=int, help='Only consider responses with that response code')
+    parser.add_argument('--count-by', help='Instead of printing the messages, count them by the value of that column')
+    parser.add_argument('--top', type=int, default=20, help='Number of values to display with --count-by (default: %(default)s)')
+    args = parser.parse_args()
+
+    qnameSuffix = None
+    if args.qname:
+        qnameSuffix = args.qname.lower().rstrip('.') + '.'
+
+    counts = collections.Counter()
+    for path in listChunkFiles(args.paths):
+        chunk = PDNSPBColumnChunk(path)
+        qtypes = chunk.getColumn('qtype')
+        rcodes = chunk.getColumn('rcode')
+        for row in chunk.getRows(args.fromTime, args.toTime):
+            if args.qtype is not None and qtypes[row] != args.qtype:
+                continue
+            if args.rcode is not None and rcodes[row] != args.rcode:
+                continue
+            if qnameSuffix:
+                qname = chunk.getString('qname', row).lower()
+                if qname != qnameSuffix and not qname.endswith('.' + qnameSuffix):
+                    continue
+            if args.count_by:
+                if args.count_by in ('from', 'to'):
+                    counts[chunk.getAddress(args.count_by, row)] += 1
+                else:
+                    counts[chunk.getValue(args.count_by, row)] += 1
+            else:
+                printRow(chunk, row)
+        chunk.close()
+
+    if args.count_by:
+        for value, count in counts.most_common(args.top):
+            print('%d\t%s' % (count, value))
+
+    sys.exit(0)
@@ -1,21 +1,71 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
+import argparse
+import array
+import asyncio
 import binascii
+import bisect
+import collections
 import datetime
+import fcntl
+import http.server
+import math
+import multiprocessing
+import os
+import queue
+import random
+import shlex
+import signal
 import socket
 import struct
 import sys
+import termios
 import threading
+import time
+import zlib
 
 # run: protoc -I=../pdns/ --python_out=. ../pdns/dnsmessage.proto
 # to generate dnsmessage_pb2
 import dnsmessage_pb2
 import google.protobuf.message
 
+import ProtobufLogCapture
+import ProtobufLogColumns
+
 class PDNSPBConnHandler(object):
 
-    def __init__(self, conn):
+    def __init__(self, conn, outputs=None, messageFilter=None, capture=None):
         self._conn = conn
+        self._outputs = outputs
+        self._filter = messageFilter
+        self._capture = capture
+        self._stats = collections.Counter()
+        self._peer = None
+        if conn is not None:
+            try:
+                self._peer = conn.getpeername()
+            except socket.error:
+                pass
+
+    def getPeerAsString(self):
+        if self._peer is None:
+            return 'N/A'
+        if len(self._peer) == 4:
+            return '[%s]:%d' % (self._peer[0], self._peer[1])
+        return '%s:%d' % (self._peer[0], self._peer[1])
+
+    def getBacklog(self):
+        """
+        Returns the number of bytes received by the kernel for this connection
+        that we have not read yet.
+        """
+        try:
+            return struct.unpack('i', fcntl.ioctl(self._conn.fileno(), termios.FIONREAD, b'\0\0\0\0'))[0]
+        except (AttributeError, ValueError, OSError):
+            return 0
+
+    def getStats(self):
+        return dict(self._stats)
 
     def run(self):
         while True:
@@ -37,25 +87,63 @@ class PDNSPBConnHandler(object):
             if len(data) != datalen:
                 break
 
-            msg = dnsmessage_pb2.PBDNSMessage()
-            try:
-                msg.ParseFromString(data)
-                if msg.type == dnsmessage_pb2.PBDNSMessage.DNSQueryType:
-                    self.printQueryMessage(msg)
-                elif msg.type == dnsmessage_pb2.PBDNSMessage.DNSResponseType:
-                    self.printResponseMessage(msg)
-                elif msg.type == dnsmessage_pb2.PBDNSMessage.DNSOutgoingQueryType:
-                    self.printOutgoingQueryMessage(msg)
-                elif msg.type == dnsmessage_pb2.PBDNSMessage.DNSIncomingResponseType:
-                    self.printIncomingResponseMessage(msg)
-                else:
-                    print('Discarding unsupported message type %d' % (msg.type))
-            except google.protobuf.message.DecodeError as exp:
-                print('Error parsing message of size %d: %s' % (datalen, str(exp)))
+            if not self.handleMessage(data):
                 break
 
         self._conn.close()
 
+    def handleMessage(self, data):
+        self._stats['messages'] += 1
+        self._stats['bytes'] += len(data)
+
+        if self._capture is not None:
+            self._capture.write(data)
+            if not self._outputs:
+                # the capture replaces the printing
+                return True
+
+        reason = None
+        if self._filter is not None:
+            reason = self._filter.checkRaw(data)
+            if reason:
+                self._stats['dropped: ' + reason] += 1
+                return True
+
+        msg = dnsmessage_pb2.PBDNSMessage()
+        try:
+            msg.ParseFromString(data)
+            self._stats[self.getTypeAsString(msg.type)] += 1
+        except google.protobuf.message.DecodeError as exp:
+            print('Error parsing message of size %d: %s' % (len(data), str(exp)))
+            self._stats['decoding errors'] += 1
+            return False
+
+        if reason is None and self._filter is not None:
+            reason = self._filter.checkMessage(msg)
+            if reason:
+                self._stats['dropped: ' + reason] += 1
+                return True
+
+        if self._outputs:
+            for output in self._outputs:
+                output.handleMessage(msg)
+        else:
+            self.printMessage(msg)
+
+        return True
+
+    def printMessage(self, msg):
+        if msg.type == dnsmessage_pb2.PBDNSMessage.DNSQueryType:
+            self.printQueryMessage(msg)
+        elif msg.type == dnsmessage_pb2.PBDNSMessage.DNSResponseType:
+            self.printResponseMessage(msg)
+        elif msg.type == dnsmessage_pb2.PBDNSMessage.DNSOutgoingQueryType:
+            self.printOutgoingQueryMessage(msg)
+        elif msg.type == dnsmessage_pb2.PBDNSMessage.DNSIncomingResponseType:
+            self.printIncomingResponseMessage(msg)
+        else:
+            print('Discarding unsupported message type %d' % (msg.type))
+
     def printQueryMessage(self, message):
         self.printSummary(message, 'Query')
         self.printQuery(message)
@@ -98,6 +186,13 @@ class PDNSPBConnHandler(object):
         elif polType == dnsmessage_pb2.PBDNSMessage.NSIP:
             return 'NS IP'
 
+    @staticmethod
+    def getTypeAsString(msgType):
+        descr =  dnsmessage_pb2.PBDNSMessage.DESCRIPTOR
+        if msgType not in descr.enum_types_by_name['Type'].values_by_number:
+            return 'unsupported'
+        return descr.EnumValueName('Type', msgType)
+
     @staticmethod
     def getEventAsString(event):
         descr =  dnsmessage_pb2.PBDNSMessage.DESCRIPTOR
@@ -264,7 +359,8 @@ class PDNSPBConnHandler(object):
                                                     serveridstr,
                                                     nod))
 
-    def getRequestorSubnet(self, msg):
+    @staticmethod
+    def getRequestorSubnet(msg):
         requestorstr = None
         if msg.HasField('originalRequestorSubnet'):
             if len(msg.originalRequestorSubnet) == 4:
@@ -275,9 +371,722 @@ class PDNSPBConnHandler(object):
                                                 msg.originalRequestorSubnet)
         return requestorstr
 
+class PDNSPBMessageFilter(object):
+    """
+    Decides which messages are worth decoding and rendering. Messages can
+    be restricted to some types and server identities, and sampled by
+    messageId so that a query and its response are kept or dropped
+    together. Messages with one of the selected rcodes or applied policy
+    types, or for a newly observed domain, are kept whatever the sampling.
+    Settings from the filter file, if any, override the command line ones
+    and are read again on SIGHUP.
+    """
+
+    types = {
+        'query': dnsmessage_pb2.PBDNSMessage.DNSQueryType,
+        'response': dnsmessage_pb2.PBDNSMessage.DNSResponseType,
+        'outgoing-query': dnsmessage_pb2.PBDNSMessage.DNSOutgoingQueryType,
+        'incoming-response': dnsmessage_pb2.PBDNSMessage.DNSIncomingResponseType
+    }
+
+    def __init__(self, args):
+        self._args = args
+        self._filterFile = args.filter_file
+        self.load(args)
+        if self._filterFile:
+            self.reload()
+
+    @staticmethod
+    def addArguments(parser):
+        group = parser.add_argument_group('filtering', 'Options that can also be set in the filter file')
+        group.add_argument('--sample', type=float,
+                           help='Fraction of the messages to keep, selected by messageId (default: 1, or 0 when --rcode, --policy-type or --nod is set)')
+        group.add_argument('--type', action='append', choices=sorted(PDNSPBMessageFilter.types), default=[],
+                           help='Only keep messages of that type, can be repeated')
+        group.add_argument('--server-identity', action='append', default=[],
+                           help='Only keep messages from that server identity, can be repeated')
+        group.add_argument('--rcode', action='append', type=int, default=[],
+                           help='Keep every response with that response code, whatever the sampling, can be repeated')
+        group.add_argument('--policy-type', action='append', default=[],
+                           choices=[value.name for value in dnsmessage_pb2.PBDNSMessage.DESCRIPTOR.enum_types_by_name['PolicyType'].values],
+                           help='Keep every response with that type of applied policy, whatever the sampling, can be repeated')
+        group.add_argument('--nod', action='store_true',
+                           help='Keep every message for a newly observed domain, whatever the sampling')
+
+    def load(self, args):
+        self._types = set(self.types[msgType] for msgType in args.type)
+        self._serverIdentities = set(serverIdentity.encode() for serverIdentity in args.server_identity)
+        self._rcodes = set(args.rcode)
+        self._policyTypes = set(dnsmessage_pb2.PBDNSMessage.PolicyType.Value(policyType) for policyType in args.policy_type)
+        self._nod = args.nod
+        self._hasKeepFilters = bool(self._rcodes or self._policyTypes or self._nod)
+        sample = args.sample
+        if sample is None:
+            sample = 0.0 if self._hasKeepFilters else 1.0
+        self._sampleThreshold = int(sample * 0x100000000)
+
+    def reload(self):
+        parser = argparse.ArgumentParser(prog=self._filterFile, add_help=False)
+        self.addArguments(parser)
+        try:
+            with open(self._filterFile) as fp:
+                fileArgs = shlex.split(fp.read(), comments=True)
+            fileSettings = vars(parser.parse_args(fileArgs))
+        except (IOError, OSError) as exp:
+            print('Error reading the filter file %s: %s' % (self._filterFile, str(exp)))
+            return
+        except SystemExit:
+            print('Error parsing the filter file %s, keeping the current filters' % (self._filterFile))
+            return
+        # the settings present in the file replace the command line ones,
+        # repeated options included
+        defaults = vars(parser.parse_args([]))
+        args = argparse.Namespace(**vars(self._args))
+        for name, value in fileSettings.items():
+            if value != defaults[name]:
+                setattr(args, name, value)
+        self.load(args)
+
+    def isActive(self):
+        return bool(self._types or self._serverIdentities or self._hasKeepFilters or self._sampleThreshold < 0x100000000)
+
+    def isSampled(self, messageId):
+        return zlib.crc32(messageId) < self._sampleThreshold
+
+    @staticmethod
+    def peekHeader(data):
+        """
+        Returns the type, messageId and serverIdentity of a serialized
+        message without decoding it, provided they come first and are short,
+        as PowerDNS products write them. Returns None otherwise.
+        """
+        if len(data) < 2 or data[0] != 0x08 or data[1] & 0x80:
+            return None
+        msgType = data[1]
+        messageId = b''
+        serverIdentity = None
+        pos = 2
+        if len(data) > pos + 1 and data[pos] == 0x12 and not data[pos + 1] & 0x80:
+            messageId = bytes(data[pos + 2:pos + 2 + data[pos + 1]])
+            pos = pos + 2 + data[pos + 1]
+        if len(data) > pos + 1 and data[pos] == 0x1a and not data[pos + 1] & 0x80:
+            serverIdentity = bytes(data[pos + 2:pos + 2 + data[pos + 1]])
+        return (msgType, messageId, serverIdentity)
+
+    def checkRaw(self, data):
+        """
+        Returns why the serialized message should be dropped, an empty
+        string if it should be kept, or None if it has to be decoded
+        before we can tell.
+        """
+        header = self.peekHeader(data)
+        if header is None:
+            return None
+        (msgType, messageId, serverIdentity) = header
+        if self._types and msgType not in self._types:
+            return 'type'
+        if self._serverIdentities:
+            if serverIdentity is None:
+                return None
+            if serverIdentity not in self._serverIdentities:
+                return 'server identity'
+        if self.isSampled(messageId):
+            return ''
+        if self._hasKeepFilters:
+            return None
+        return 'sampling'
+
+    def checkMessage(self, msg):
+        """
+        Returns why the decoded message should be dropped, or an empty
+        string if it should be kept.
+        """
+        if self._types and msg.type not in self._types:
+            return 'type'
+        if self._serverIdentities and msg.serverIdentity not in self._serverIdentities:
+            return 'server identity'
+        if self.isSampled(msg.messageId):
+            return ''
+        if self._nod and msg.newlyObservedDomain:
+            return ''
+        if msg.HasField('response'):
+            response = msg.response
+            if response.HasField('rcode') and response.rcode in self._rcodes:
+                return ''
+            if response.HasField('appliedPolicyType') and response.appliedPolicyType in self._policyTypes:
+                return ''
+        return 'sampling'
+
+class PDNSPBOutput(object):
+    """
+    Base class for the consumers of decoded messages that can replace the
+    default printing. handleMessage() might be called from several
+    connection threads at once.
+    """
+
+    def start(self, listener):
+        pass
+
+    def stop(self):
+        pass
+
+    def handleMessage(self, msg):
+        pass
+
+class PDNSPBLatencyHistogram(object):
+    """
+    Log-linear histogram of latencies in microseconds: 16 buckets per power
+    of two, so that percentiles are accurate to about 6% in constant memory.
+    """
+
+    def __init__(self):
+        self._buckets = collections.Counter()
+        self.count = 0
+
+    @staticmethod
+    def getBucket(value):
+        if value < 16:
+            return max(value, 0)
+        shift = value.bit_length() - 5
+        return (shift << 4) + (value >> shift)
+
+    @staticmethod
+    def getBucketUpperBound(bucket):
+        if bucket < 16:
+            return bucket
+        shift = (bucket >> 4) - 1
+        return ((bucket - (shift << 4) + 1) << shift) - 1
+
+    def add(self, value):
+        self._buckets[self.getBucket(value)] += 1
+        self.count += 1
+
+    def getPercentile(self, percentile):
+        target = max(1, int(math.ceil(self.count * percentile / 100.0)))
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= target:
+                return self.getBucketUpperBound(bucket)
+        return 0
+
+class PDNSPBLatencyAggregator(PDNSPBOutput):
+    """
+    Correlates queries with their responses using the messageId, and reports
+    latency percentiles per query type, response code and server identity
+    every interval. Queries waiting for their response are kept, in arrival
+    order, in a table bounded both in size and in age.
+    """
+
+    percentiles = (50, 90, 99, 99.9)
+    queryTypes = {
+        dnsmessage_pb2.PBDNSMessage.DNSResponseType: dnsmessage_pb2.PBDNSMessage.DNSQueryType,
+        dnsmessage_pb2.PBDNSMessage.DNSIncomingResponseType: dnsmessage_pb2.PBDNSMessage.DNSOutgoingQueryType
+    }
+    queryTypesAsString = {
+        dnsmessage_pb2.PBDNSMessage.DNSQueryType: 'Query',
+        dnsmessage_pb2.PBDNSMessage.DNSOutgoingQueryType: 'Query (O)'
+    }
+
+    def __init__(self, interval, ttl, maxPending):
+        self._interval = interval
+        self._ttl = ttl
+        self._maxPending = maxPending
+        self._pending = collections.OrderedDict()
+        self._histograms = collections.defaultdict(PDNSPBLatencyHistogram)
+        self._counters = collections.Counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._lastReport = time.monotonic()
+        self._thread = None
+
+    def start(self, listener):
+        self._lastReport = time.monotonic()
+        self._thread = threading.Thread(name='Latency Reporter', target=self.runReporter)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self.report()
+
+    def runReporter(self):
+        while not self._stopped.wait(self._interval):
+            self.report()
+
+    @staticmethod
+    def getTimeUsec(sec, usec):
+        return sec * 1000000 + usec
+
+    def expire(self, now):
+        pending = self._pending
+        while pending:
+            (arrival, _) = pending[next(iter(pending))]
+            if arrival >= now - self._ttl and len(pending) <= self._maxPending:
+                break
+            pending.popitem(last=False)
+            self._counters['expired'] += 1
+
+    def handleMessage(self, msg):
+        now = time.monotonic()
+        with self._lock:
+            if msg.type in self.queryTypes.values():
+                self._pending[(msg.type, msg.messageId)] = (now, self.getTimeUsec(msg.timeSec, msg.timeUsec))
+                self.expire(now)
+                return
+
+            queryType = self.queryTypes.get(msg.type)
+            if queryType is None:
+                return
+
+            response = msg.response
+            query = self._pending.pop((queryType, msg.messageId), None)
+            if query is not None:
+                queryTime = query[1]
+            elif response.HasField('queryTimeSec'):
+                # the query was not seen (yet), but the response tells us when it was received
+                queryTime = self.getTimeUsec(response.queryTimeSec, response.queryTimeUsec)
+            else:
+                self._counters['unmatched'] += 1
+                return
+
+            key = (self.queryTypesAsString[queryType],
+                   msg.question.qType,
+                   response.rcode,
+                   msg.serverIdentity.decode(errors='replace') if msg.HasField('serverIdentity') else 'N/A')
+            self._histograms[key].add(self.getTimeUsec(msg.timeSec, msg.timeUsec) - queryTime)
+            self._counters['responses'] += 1
+
+    def report(self):
+        now = time.monotonic()
+        with self._lock:
+            self.expire(now)
+            histograms = self._histograms
+            counters = self._counters
+            pending = len(self._pending)
+            self._histograms = collections.defaultdict(PDNSPBLatencyHistogram)
+            self._counters = collections.Counter()
+        elapsed = now - self._lastReport
+        self._lastReport = now
+
+        datestr = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        print('[%s] Latency over the last %ds: %d responses, %d unmatched, %d expired, %d pending queries' % (datestr,
+                                                                                                              elapsed,
+                                                                                                              counters['responses'],
+                                                                                                              counters['unmatched'],
+                                                                                                              counters['expired'],
+                                                                                                              pending))
+        for key in sorted(histograms):
+            histogram = histograms[key]
+            percentilesstr = ', '.join('p%s: %dus' % (str(percentile).replace('.', ''), histogram.getPercentile(percentile)) for percentile in self.percentiles)
+            print("- %s qtype: %d, rcode: %d, serverid: %s, count: %d, %s" % (key[0],
+                                                                           key[1],
+                                                                           key[2],
+                                                                           key[3],
+                                                                           histogram.count,
+                                                                           percentilesstr))
+
+class PDNSPBColumnarOutput(PDNSPBOutput):
+    """
+    Instead of printing the messages, appends their main fields to columnar
+    chunks (see ProtobufLogColumns.py) written to a directory. A chunk is
+    written once it holds chunkRows messages or is chunkSeconds old, from a
+    separate thread so that the disk writes do not hold the receiving path.
+    """
+
+    def __init__(self, directory, chunkRows, chunkSeconds):
+        self._directory = directory
+        self._chunkRows = chunkRows
+        self._chunkSeconds = chunkSeconds
+        self._chunk = ProtobufLogColumns.PDNSPBColumnChunkBuilder()
+        self._chunkStart = time.monotonic()
+        self._chunkSerial = 0
+        self._lock = threading.Lock()
+        self._pending = queue.Queue()
+        self._thread = None
+
+    def start(self, listener):
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        self._thread = threading.Thread(name='Columnar Writer', target=self.runWriter)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self.rotate()
+        self._pending.put(None)
+        self._thread.join()
+
+    def handleMessage(self, msg):
+        with self._lock:
+            self._chunk.appendMessage(msg)
+            if self._chunk.rows >= self._chunkRows:
+                self.rotate()
+
+    def rotate(self):
+        # called with the lock held
+        if self._chunk.rows > 0:
+            self._pending.put(self._chunk)
+            self._chunk = ProtobufLogColumns.PDNSPBColumnChunkBuilder()
+        self._chunkStart = time.monotonic()
+
+    def runWriter(self):
+        while True:
+            try:
+                chunk = self._pending.get(timeout=1)
+            except queue.Empty:
+                with self._lock:
+                    if time.monotonic() - self._chunkStart >= self._chunkSeconds:
+                        self.rotate()
+                continue
+
+            if chunk is None:
+                break
+
+            self._chunkSerial += 1
+            path = os.path.join(self._directory, 'pblog-%d-%d-%d.pbc' % (chunk.minTime, os.getpid(), self._chunkSerial))
+            try:
+                chunk.write(path)
+            except (IOError, OSError) as exp:
+                print('Error while writing %d messages to %s: %s' % (chunk.rows, path, str(exp)))
+
+class PDNSPBHeavyHitters(object):
+    """
+    Finds the most frequent values of a stream in bounded memory. A
+    count-min sketch estimates the frequency of every value, and a value
+    only enters the fixed-size table of candidates when its estimate beats
+    the smallest tracked one, which it then replaces as in space-saving.
+    """
+
+    prime = (1 << 61) - 1
+
+    def __init__(self, width, depth, capacity):
+        self._width = width
+        self._capacity = capacity
+        self._hashes = [(random.randrange(1, self.prime), random.randrange(0, self.prime)) for _ in range(depth)]
+        self.reset()
+
+    def reset(self):
+        self._counters = array.array('I', bytes(4 * self._width * len(self._hashes)))
+        self._candidates = {}
+        self._threshold = 0
+        self.total = 0
+
+    def add(self, value):
+        counters = self._counters
+        width = self._width
+        prime = self.prime
+        h = hash(value)
+        base = 0
+        estimate = None
+        for (a, b) in self._hashes:
+            idx = base + (a * h + b) % prime % width
+            count = counters[idx] + 1
+            counters[idx] = count
+            if estimate is None or count < estimate:
+                estimate = count
+            base += width
+        self.total += 1
+
+        candidates = self._candidates
+        if value in candidates or len(candidates) < self._capacity:
+            candidates[value] = estimate
+        elif estimate > self._threshold:
+            smallest = min(candidates, key=candidates.get)
+            if candidates[smallest] < estimate:
+                del candidates[smallest]
+                candidates[value] = estimate
+                smallest = min(candidates, key=candidates.get)
+            self._threshold = candidates[smallest]
+
+    def getTop(self, count):
+        return sorted(self._candidates.items(), key=lambda item: item[1], reverse=True)[:count]
+
+class PDNSPBHeavyHittersOutput(PDNSPBOutput):
+    """
+    Instead of printing the messages, reports every interval the most
+    frequent requestors (ECS subnet if any, source address otherwise),
+    qnames, qname suffixes, response codes and applied policies seen during
+    that interval.
+    """
+
+    dimensions = ('requestor', 'qname', 'suffix', 'rcode', 'policy')
+
+    def __init__(self, interval, top, suffixLabels, msgType, width, depth):
+        self._interval = interval
+        self._top = top
+        self._suffixLabels = suffixLabels
+        self._msgType = msgType
+        self._sketches = dict((dimension, PDNSPBHeavyHitters(width, depth, max(top * 10, 100))) for dimension in self.dimensions)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._lastReport = time.monotonic()
+        self._thread = None
+
+    def start(self, listener):
+        self._lastReport = time.monotonic()
+        self._thread = threading.Thread(name='Heavy Hitters Reporter', target=self.runReporter)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self.report()
+
+    def runReporter(self):
+        while not self._stopped.wait(self._interval):
+            self.report()
+
+    def handleMessage(self, msg):
+        if msg.type != self._msgType:
+            return
+
+        requestor = PDNSPBConnHandler.getRequestorSubnet(msg)
+        if requestor is None and msg.HasField('from'):
+            fromvalue = getattr(msg, 'from')
+            requestor = socket.inet_ntop(socket.AF_INET if len(fromvalue) == 4 else socket.AF_INET6, fromvalue)
+        qname = msg.question.qName.lower()
+        suffix = '.'.join(qname.rstrip('.').split('.')[-self._suffixLabels:]) + '.'
+
+        sketches = self._sketches
+        with self._lock:
+            if requestor is not None:
+                sketches['requestor'].add(requestor)
+            sketches['qname'].add(qname)
+            sketches['suffix'].add(suffix)
+            if msg.HasField('response'):
+                sketches['rcode'].add(msg.response.rcode)
+                if msg.response.appliedPolicy:
+                    sketches['policy'].add(msg.response.appliedPolicy)
+
+    def report(self):
+        now = time.monotonic()
+        with self._lock:
+            tops = [(dimension, self._sketches[dimension].total, self._sketches[dimension].getTop(self._top)) for dimension in self.dimensions]
+            for sketch in self._sketches.values():
+                sketch.reset()
+        elapsed = now - self._lastReport
+        self._lastReport = now
+
+        datestr = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        print('[%s] Top %d over the last %ds:' % (datestr, self._top, elapsed))
+        for dimension, total, top in tops:
+            print('- %s (%d messages):' % (dimension, total))
+            for value, count in top:
+                print('\t- %d (%.1f%%) %s' % (count, 100.0 * count / total, value))
+
+class PDNSPBPrometheusOutput(PDNSPBOutput):
+    """
+    Maintains counters and histograms as the messages arrive and serves them
+    in the Prometheus text format over HTTP. In the --workers mode, each
+    worker serves its own metrics on port + its worker number.
+    """
+
+    prefix = 'protobuflogger_'
+    # upper bounds, in seconds, of the response latency buckets
+    latencyBuckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, addr, port, printMessages):
+        self._addr = addr
+        self._port = port
+        self._printMessages = printMessages
+        self._listener = None
+        self._server = None
+        self._lock = threading.Lock()
+        self._transports = collections.Counter()
+        self._rcodes = collections.Counter()
+        self._policies = collections.Counter()
+        self._latencyCounts = [0] * (len(self.latencyBuckets) + 1)
+        self._latencySum = 0.0
+        self._latencyBoundsUsec = [int(bound * 1000000) for bound in self.latencyBuckets]
+
+    def start(self, listener):
+        self._listener = listener
+        output = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                content = output.getMetrics().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = http.server.ThreadingHTTPServer((self._addr, self._port + listener.workerId), MetricsHandler)
+        except socket.error as exp:
+            print("Error while binding the metrics server: %s" % str(exp))
+            sys.exit(1)
+        self._server.daemon_threads = True
+        thread = threading.Thread(name='Metrics Server', target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def handleMessage(self, msg):
+        transport = PDNSPBConnHandler.getTransportAsString(msg.socketProtocol) if msg.HasField('socketProtocol') else 'N/A'
+        with self._lock:
+            self._transports[(PDNSPBConnHandler.getTypeAsString(msg.type), transport)] += 1
+            if msg.HasField('response'):
+                response = msg.response
+                self._rcodes[(PDNSPBConnHandler.getTypeAsString(msg.type), response.rcode)] += 1
+                if response.appliedPolicy:
+                    self._policies[(response.appliedPolicy, self.getPolicyTypeAsString(response))] += 1
+                if response.HasField('queryTimeSec'):
+                    latency = (msg.timeSec - response.queryTimeSec) * 1000000 + msg.timeUsec - response.queryTimeUsec
+                    self._latencyCounts[bisect.bisect_left(self._latencyBoundsUsec, latency)] += 1
+                    self._latencySum += latency / 1000000.0
+
+        if self._printMessages:
+            PDNSPBConnHandler(None).printMessage(msg)
+
+    @staticmethod
+    def getPolicyTypeAsString(response):
+        if not response.HasField('appliedPolicyType'):
+            return 'N/A'
+        return PDNSPBConnHandler.getAppliedPolicyTypeAsString(response.appliedPolicyType) or 'N/A'
+
+    @staticmethod
+    def getLabelValue(value):
+        # a metric line must not contain any whitespace
+        return '_'.join(str(value).split()).replace('\\', '\\\\').replace('"', '\\"')
+
+    def addMetric(self, lines, name, metricType, description, values):
+        name = self.prefix + name
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, metricType))
+        for labels, value in values:
+            if labels:
+                labelsstr = ','.join('%s="%s"' % (label, self.getLabelValue(labelValue)) for label, labelValue in labels)
+                lines.append('%s{%s} %s' % (name, labelsstr, value))
+            else:
+                lines.append('%s %s' % (name, value))
+
+    def getMetrics(self):
+        stats = self._listener.getStats()
+        backlogs = self._listener.getBacklogs()
+        with self._lock:
+            transports = self._transports.copy()
+            rcodes = self._rcodes.copy()
+            policies = self._policies.copy()
+            latencyCounts = list(self._latencyCounts)
+            latencySum = self._latencySum
+
+        descr = dnsmessage_pb2.PBDNSMessage.DESCRIPTOR
+        types = [value.name for value in descr.enum_types_by_name['Type'].values] + ['unsupported']
+
+        lines = []
+        self.addMetric(lines, 'messages_total', 'counter', 'Number of messages received, by type',
+                       [((('type', msgType),), stats[msgType]) for msgType in types])
+        self.addMetric(lines, 'bytes_total', 'counter', 'Number of bytes of messages received',
+                       [((), stats['bytes'])])
+        self.addMetric(lines, 'decoding_errors_total', 'counter', 'Number of messages that could not be decoded',
+                       [((), stats['decoding errors'])])
+        self.addMetric(lines, 'dropped_messages_total', 'counter', 'Number of messages dropped by the filters, by reason',
+                       [((('reason', reason), ), stats['dropped: ' + reason]) for reason in ('type', 'server identity', 'sampling')])
+        self.addMetric(lines, 'connections_total', 'counter', 'Number of connections accepted',
+                       [((), stats['connections'])])
+        self.addMetric(lines, 'transport_messages_total', 'counter', 'Number of messages received, by type and transport',
+                       [((('type', key[0]), ('transport', key[1])), transports[key]) for key in sorted(transports)])
+        self.addMetric(lines, 'rcode_responses_total', 'counter', 'Number of responses received, by type and response code',
+                       [((('type', key[0]), ('rcode', key[1])), rcodes[key]) for key in sorted(rcodes)])
+        self.addMetric(lines, 'policy_hits_total', 'counter', 'Number of responses with an applied policy, by policy',
+                       [((('policy', key[0]), ('policytype', key[1])), policies[key]) for key in sorted(policies)])
+
+        name = self.prefix + 'response_latency_seconds'
+        self.addMetric(lines, 'response_latency_seconds', 'histogram', 'Time between the reception of a query and the sending of its response', [])
+        cumulative = 0
+        for bound, count in zip(self.latencyBuckets + ('+Inf',), latencyCounts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %d' % (name, bound, cumulative))
+        lines.append('%s_sum %f' % (name, latencySum))
+        lines.append('%s_count %d' % (name, cumulative))
+
+        self.addMetric(lines, 'connection_backlog_bytes', 'gauge', 'Number of bytes received by the kernel but not read yet, by connection',
+                       [((('connection', peer),), backlog) for peer, backlog in sorted(backlogs)])
+        return '\n'.join(lines) + '\n'
+
+class PDNSPBStreamProtocol(asyncio.BufferedProtocol):
+    """
+    Frames the 16-bit length-prefixed PBDNSMessage stream of one connection.
+    The kernel writes straight into a reusable receive buffer and messages
+    are decoded from views into it, so the only copy made is moving an
+    incomplete trailing frame back to the start of the buffer.
+    """
+
+    def __init__(self, listener, bufferSize):
+        self._listener = listener
+        self._handler = None
+        # a full frame (length prefix included) must always fit
+        self._buffer = bytearray(max(bufferSize, 2 + 65535))
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._handler = PDNSPBConnHandler(transport.get_extra_info('socket'),
+                                          self._listener.getOutputs(),
+                                          self._listener.getFilter(),
+                                          self._listener.getCapture())
+        self._listener.addHandler(self._handler)
+
+    def connection_lost(self, exc):
+        self._listener.removeHandler(self._handler)
+
+    def get_buffer(self, sizehint):
+        if self._end == len(self._buffer):
+            pending = self._end - self._start
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = pending
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        buf = self._buffer
+        view = self._view
+        start = self._start
+        end = self._end + nbytes
+
+        while end - start >= 2:
+            (datalen,) = struct.unpack_from("!H", buf, start)
+            frameEnd = start + 2 + datalen
+            if frameEnd > end:
+                break
+            if not self._handler.handleMessage(view[start + 2:frameEnd]):
+                self._transport.close()
+                break
+            start = frameEnd
+
+        if start == end:
+            start = end = 0
+        self._start = start
+        self._end = end
+
+    def eof_received(self):
+        return False
+
 class PDNSPBListener(object):
 
-    def __init__(self, addr, port):
+    def __init__(self, addr, port, outputs=None, messageFilter=None, capture=None):
+        self._outputs = outputs or []
+        self._filter = messageFilter
+        self._capture = capture
+        # set on the listeners of the --workers mode
+        self.workerId = 0
         res = socket.getaddrinfo(addr, port, socket.AF_UNSPEC,
                                  socket.SOCK_STREAM, 0,
                                  socket.AI_PASSIVE)
@@ -295,23 +1104,278 @@ class PDNSPBListener(object):
 
         self._sock.listen(100)
 
+        # counters of the connections that are already closed
+        self._stats = collections.Counter()
+        self._handlers = set()
+        self._handlersLock = threading.Lock()
+
+    def getsockname(self):
+        return self._sock.getsockname()
+
+    def getOutputs(self):
+        return self._outputs
+
+    def getFilter(self):
+        return self._filter
+
+    def getCapture(self):
+        return self._capture
+
+    def startOutputs(self):
+        if self._capture is not None:
+            self._capture.open()
+        for output in self._outputs:
+            output.start(self)
+
+    def stopOutputs(self):
+        for output in self._outputs:
+            output.stop()
+        if self._capture is not None:
+            self._capture.close()
+
+    def close(self):
+        self._sock.close()
+
+    def addHandler(self, handler):
+        with self._handlersLock:
+            self._handlers.add(handler)
+            self._stats['connections'] += 1
+
+    def removeHandler(self, handler):
+        with self._handlersLock:
+            self._handlers.discard(handler)
+            self._stats.update(handler.getStats())
+
+    def getStats(self):
+        with self._handlersLock:
+            stats = self._stats.copy()
+            for handler in self._handlers:
+                stats.update(handler.getStats())
+        return stats
+
+    def getBacklogs(self):
+        with self._handlersLock:
+            handlers = list(self._handlers)
+        return [(handler.getPeerAsString(), handler.getBacklog()) for handler in handlers]
+
+    def handleConnection(self, handler):
+        self.addHandler(handler)
+        try:
+            handler.run()
+        finally:
+            self.removeHandler(handler)
+
     def run(self):
+        self.startOutputs()
+        try:
+            self.serve()
+        finally:
+            self.stopOutputs()
+
+    def serve(self):
         while True:
             (conn, _) = self._sock.accept()
 
-            handler = PDNSPBConnHandler(conn)
+            handler = PDNSPBConnHandler(conn, self._outputs, self._filter, self._capture)
             thread = threading.Thread(name='Connection Handler',
-                                      target=PDNSPBConnHandler.run,
+                                      target=self.handleConnection,
                                       args=[handler])
             thread.setDaemon(True)
             thread.start()
 
         self._sock.close()
 
+class PDNSPBAsyncListener(PDNSPBListener):
+    """
+    Serves every connection from a single asyncio event loop instead of
+    spawning one thread per connection.
+    """
+
+    def __init__(self, addr, port, bufferSize=262144, outputs=None, messageFilter=None, capture=None):
+        super(PDNSPBAsyncListener, self).__init__(addr, port, outputs, messageFilter, capture)
+        self._bufferSize = bufferSize
+
+    def serve(self):
+        asyncio.run(self.serveAsync())
+
+    async def serveAsync(self):
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: PDNSPBStreamProtocol(self, self._bufferSize),
+                                          sock=self._sock)
+        async with server:
+            await server.serve_forever()
+
+
+def formatStats(stats):
+    return ', '.join('%s: %d' % (key, stats[key]) for key in sorted(stats))
+
+def raiseKeyboardInterrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def reloadFilter(listener):
+    def handler(signum, frame):
+        if listener.getFilter() is not None:
+            listener.getFilter().reload()
+    signal.signal(signal.SIGHUP, handler)
+
+def runWorker(listeners, workerId, results):
+    listener = listeners[workerId]
+    listener.workerId = workerId
+    for other in listeners:
+        if other is not listener:
+            other.close()
+
+    # the parent process handles ^C and stops us with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, raiseKeyboardInterrupt)
+    reloadFilter(listener)
+    # one write per line so that the output of the workers does not get mixed mid-line
+    sys.stdout.reconfigure(line_buffering=True)
+    try:
+        listener.run()
+    except KeyboardInterrupt:
+        pass
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    results.put((workerId, listener.getStats()))
+
+def runWorkers(listeners):
+    """
+    Runs one process per listener. Every listener has its own socket bound
+    with SO_REUSEPORT, so the kernel spreads the incoming connections over
+    the workers, which decode independently. The per-worker counters are
+    merged into a summary when we are asked to stop.
+    """
+    # the listeners, holding bound sockets and locks, cannot be pickled so the
+    # workers have to be forked, whatever the default start method is
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    workers = []
+    for workerId in range(len(listeners)):
+        worker = ctx.Process(target=runWorker,
+                             args=(listeners, workerId, results),
+                             name='Worker %d' % (workerId))
+        worker.start()
+        workers.append(worker)
+    # the sockets now belong to the workers
+    for listener in listeners:
+        listener.close()
+
+    signal.signal(signal.SIGTERM, raiseKeyboardInterrupt)
+    # the workers reload their filters themselves
+    def forwardSIGHUP(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGHUP)
+    signal.signal(signal.SIGHUP, forwardSIGHUP)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+
+    running = [worker for worker in workers if worker.is_alive()]
+    for worker in running:
+        os.kill(worker.pid, signal.SIGTERM)
+
+    total = collections.Counter()
+    perWorker = {}
+    for _ in running:
+        try:
+            workerId, stats = results.get(timeout=5)
+        except queue.Empty:
+            break
+        perWorker[workerId] = stats
+        total.update(stats)
+
+    for worker in workers:
+        worker.join(1)
+
+    for workerId in sorted(perWorker):
+        print('Worker %d: %s' % (workerId, formatStats(perWorker[workerId])))
+    print('Total (%d/%d workers): %s' % (len(perWorker), len(workers), formatStats(total)))
+
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        sys.exit('Usage: %s <address> <port>' % (sys.argv[0]))
+    parser = argparse.ArgumentParser(description='Display the protobuf messages exported by PowerDNS products')
+    parser.add_argument('address', help='Address to listen on')
+    parser.add_argument('port', help='Port to listen on')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='Serve all connections from one asyncio event loop instead of one thread per connection')
+    parser.add_argument('--buffer-size', type=int, default=262144,
+                        help='Size of the per-connection receive buffer in asyncio mode (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Fork that many listener processes sharing the port, and print their merged statistics on exit')
+    parser.add_argument('--latency-interval', type=int, default=0,
+                        help='Instead of printing the messages, report query/response latency percentiles every that many seconds')
+    parser.add_argument('--latency-ttl', type=int, default=30,
+                        help='Number of seconds a query waits for its response before being evicted (default: %(default)s)')
+    parser.add_argument('--latency-max-pending', type=int, default=1000000,
+                        help='Maximum number of queries waiting for their response (default: %(default)s)')
+    parser.add_argument('--columnar-dir',
+                        help='Instead of printing the messages, store them in columnar chunk files in that directory')
+    parser.add_argument('--columnar-chunk-rows', type=int, default=100000,
+                        help='Maximum number of messages in a columnar chunk (default: %(default)s)')
+    parser.add_argument('--columnar-chunk-seconds', type=int, default=60,
+                        help='Maximum number of seconds a columnar chunk stays open (default: %(default)s)')
+    parser.add_argument('--hitters-interval', type=int, default=0,
+                        help='Instead of printing the messages, report the most frequent requestors, qnames, qname suffixes, rcodes and policies every that many seconds')
+    parser.add_argument('--hitters-top', type=int, default=10,
+                        help='Number of values to report for each field (default: %(default)s)')
+    parser.add_argument('--hitters-suffix-labels', type=int, default=2,
+                        help='Number of labels of the qname suffixes (default: %(default)s)')
+    parser.add_argument('--hitters-type', choices=['query', 'response'], default='response',
+                        help='Type of messages to count, only responses carry rcodes and policies (default: %(default)s)')
+    parser.add_argument('--hitters-width', type=int, default=65536,
+                        help='Number of counters in each row of the count-min sketches (default: %(default)s)')
+    parser.add_argument('--hitters-depth', type=int, default=4,
+                        help='Number of rows of the count-min sketches (default: %(default)s)')
+    parser.add_argument('--prometheus-port', type=int, default=0,
+                        help='Serve Prometheus metrics over HTTP on that port, at /metrics')
+    parser.add_argument('--prometheus-address', default='127.0.0.1',
+                        help='Address to serve the Prometheus metrics on (default: %(default)s)')
+    parser.add_argument('--capture',
+                        help='Instead of printing the messages, record the raw stream and its index to that file for ProtobufLogCapture.py to replay. In the --workers mode, worker N writes to <file>.N')
+    parser.add_argument('--filter-file',
+                        help='File holding filtering options, read at startup and on SIGHUP')
+    PDNSPBMessageFilter.addArguments(parser)
+    args = parser.parse_args()
+
+    messageFilter = PDNSPBMessageFilter(args)
+    if not messageFilter.isActive() and not args.filter_file:
+        messageFilter = None
 
-    PDNSPBListener(sys.argv[1], sys.argv[2]).run()
+    outputs = []
+    if args.hitters_interval > 0:
+        hittersType = dnsmessage_pb2.PBDNSMessage.DNSQueryType if args.hitters_type == 'query' else dnsmessage_pb2.PBDNSMessage.DNSResponseType
+        outputs.append(PDNSPBHeavyHittersOutput(args.hitters_interval, args.hitters_top, args.hitters_suffix_labels,
+                                                hittersType, args.hitters_width, args.hitters_depth))
+    if args.columnar_dir:
+        outputs.append(PDNSPBColumnarOutput(args.columnar_dir, args.columnar_chunk_rows, args.columnar_chunk_seconds))
+    if args.latency_interval > 0:
+        outputs.append(PDNSPBLatencyAggregator(args.latency_interval, args.latency_ttl, args.latency_max_pending))
+
+    if args.prometheus_port > 0:
+        # keep printing the messages unless another output replaces it
+        outputs.append(PDNSPBPrometheusOutput(args.prometheus_address, args.prometheus_port, len(outputs) == 0))
+
+    listeners = []
+    for workerId in range(max(args.workers, 1)):
+        capture = None
+        if args.capture:
+            capture = ProtobufLogCapture.PDNSPBCaptureWriter(args.capture if args.workers == 0 else '%s.%d' % (args.capture, workerId))
+        if args.asyncio:
+            listeners.append(PDNSPBAsyncListener(args.address, args.port, args.buffer_size, outputs, messageFilter, capture))
+        else:
+            listeners.append(PDNSPBListener(args.address, args.port, outputs, messageFilter, capture))
+
+    if args.workers > 0:
+        runWorkers(listeners)
+    else:
+        # let the outputs flush their data when we are asked to stop
+        signal.signal(signal.SIGTERM, raiseKeyboardInterrupt)
+        reloadFilter(listeners[0])
+        try:
+            listeners[0].run()
+        except KeyboardInterrupt:
+            pass
     sys.exit(0)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# Measures how many PBDNSMessages per second ProtobufLogger.py can receive,
+# by pushing a synthetic remoteLog stream from a separate exporter process
+# over many concurrent connections.
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+
+# run: protoc -I=../pdns/ --python_out=. ../pdns/dnsmessage.proto
+# to generate dnsmessage_pb2
+import dnsmessage_pb2
+import ProtobufLogger
+
+def buildSyntheticMessages():
+    query = dnsmessage_pb2.PBDNSMessage()
+    query.type = dnsmessage_pb2.PBDNSMessage.DNSQueryType
+    query.messageId = os.urandom(16)
+    query.serverIdentity = b'benchmark'
+    query.socketFamily = dnsmessage_pb2.PBDNSMessage.INET
+    query.socketProtocol = dnsmessage_pb2.PBDNSMessage.UDP
+    setattr(query, 'from', socket.inet_pton(socket.AF_INET, '192.0.2.1'))
+    query.to = socket.inet_pton(socket.AF_INET, '192.0.2.53')
+    query.inBytes = 42
+    query.timeSec = int(time.time())
+    query.timeUsec = 0
+    query.id = 4242
+    query.question.qName = 'www.example.org.'
+    query.question.qType = 1
+    query.question.qClass = 1
+
+    response = dnsmessage_pb2.PBDNSMessage()
+    response.CopyFrom(query)
+    response.type = dnsmessage_pb2.PBDNSMessage.DNSResponseType
+    response.response.rcode = 0
+    response.response.queryTimeSec = query.timeSec
+    response.response.queryTimeUsec = query.timeUsec
+    rr = response.response.rrs.add()
+    rr.name = 'www.example.org.'
+    rr.type = 1
+    setattr(rr, 'class', 1)
+    rr.ttl = 3600
+    rr.rdata = socket.inet_pton(socket.AF_INET, '192.0.2.80')
+
+    data = b''
+    for msg in (query, response):
+        wire = msg.SerializeToString()
+        data = data + struct.pack("!H", len(wire)) + wire
+    return data
+
+def runExporter(sockaddr, connections, pairs, ready):
+    """
+    Opens all the connections first, then pushes pairs query/response
+    frames down each of them without blocking on any single one.
+    """
+    payload = buildSyntheticMessages() * pairs
+    sel = selectors.DefaultSelector()
+    socks = []
+    for _ in range(connections):
+        sock = socket.create_connection(sockaddr)
+        sock.setblocking(False)
+        socks.append(sock)
+    ready.wait()
+
+    for sock in socks:
+        sel.register(sock, selectors.EVENT_WRITE, memoryview(payload))
+    while sel.get_map():
+        for key, _ in sel.select():
+            sent = key.fileobj.send(key.data)
+            remaining = key.data[sent:]
+            if remaining:
+                sel.modify(key.fileobj, selectors.EVENT_WRITE, remaining)
+            else:
+                sel.unregister(key.fileobj)
+                key.fileobj.close()
+
+def benchmark(listenerClass, connections, pairs):
+    total = connections * pairs * 2
+    counter = itertools.count(1)
+    done = threading.Event()
+    handleMessage = ProtobufLogger.PDNSPBConnHandler.handleMessage
+
+    def countingHandleMessage(self, data):
+        ret = handleMessage(self, data)
+        if next(counter) == total:
+            done.set()
+        return ret
+
+    ProtobufLogger.PDNSPBConnHandler.handleMessage = countingHandleMessage
+    try:
+        listener = listenerClass('127.0.0.1', 0)
+        thread = threading.Thread(name='Listener', target=listener.run)
+        thread.daemon = True
+        thread.start()
+
+        ready = multiprocessing.Event()
+        exporter = multiprocessing.Process(target=runExporter,
+                                           args=(listener.getsockname(), connections, pairs, ready))
+        exporter.start()
+        # give the exporter the time to establish its connections
+        time.sleep(1)
+        start = time.monotonic()
+        ready.set()
+        if not done.wait(600):
+            sys.exit('Timeout while waiting for the listener to process %d messages' % (total))
+        elapsed = time.monotonic() - start
+        exporter.join()
+    finally:
+        ProtobufLogger.PDNSPBConnHandler.handleMessage = handleMessage
+
+    return total, elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the ProtobufLogger.py listeners against a synthetic exporter')
+    parser.add_argument('--connections', type=int, default=100,
+                        help='Number of concurrent exporter connections (default: %(default)s)')
+    parser.add_argument('--pairs', type=int, default=5000,
+                        help='Number of query/response pairs sent over each connection (default: %(default)s)')
+    parser.add_argument('--mode', choices=['threads', 'asyncio', 'both'], default='both',
+                        help='Listener implementation to benchmark (default: %(default)s)')
+    parser.add_argument('--decode-only', action='store_true',
+                        help='Skip the printing of the decoded messages')
+    args = parser.parse_args()
+
+    listeners = []
+    if args.mode in ('threads', 'both'):
+        listeners.append(('threads', ProtobufLogger.PDNSPBListener))
+    if args.mode in ('asyncio', 'both'):
+        listeners.append(('asyncio', ProtobufLogger.PDNSPBAsyncListener))
+
+    if args.decode_only:
+        for name in ('printQueryMessage', 'printResponseMessage', 'printOutgoingQueryMessage', 'printIncomingResponseMessage'):
+            setattr(ProtobufLogger.PDNSPBConnHandler, name, lambda self, message: None)
+
+    results = []
+    stdout = sys.stdout
+    for name, listenerClass in listeners:
+        # the messages are still rendered, but not to the terminal
+        with open(os.devnull, 'w') as devnull:
+            sys.stdout = devnull
+            try:
+                results.append((name, benchmark(listenerClass, args.connections, args.pairs)))
+            finally:
+                sys.stdout = stdout
+
+    for name, (total, elapsed) in results:
+        print('%s: %d messages over %d connections in %.2fs, %.0f msgs/s' % (name, total, args.connections, elapsed, total / elapsed))
+
+    sys.exit(0)
@@ -1,9 +1,22 @@
 #!/usr/bin/env python3
 
-from bcc import BPF
+import argparse
+import array
 import ctypes as ct
-import netaddr
+import datetime
+import errno
+import heapq
+import http.server
+import itertools
+import json
+import operator
+import os
 import socket
+import struct
+import sys
+import threading
+import time
+import urllib.request
 
 # Constants
 QTYPES = {'LOC': 29, '*': 255, 'IXFR': 251, 'UINFO': 100, 'NSEC3': 50, 'AAAA': 28, 'CNAME': 5, 'MINFO': 14, 'EID': 31, 'GPOS': 27, 'X25': 19, 'HINFO': 13, 'CAA': 257, 'NULL': 10, 'DNSKEY': 48, 'DS': 43, 'ISDN': 20, 'SOA': 6, 'RP': 17, 'UID': 101, 'TALINK': 58, 'TKEY': 249, 'PX': 26, 'NSAP-PTR': 23, 'TXT': 16, 'IPSECKEY': 45, 'DNAME': 39, 'MAILA': 254, 'AFSDB': 18, 'SSHFP': 44, 'NS': 2, 'PTR': 12, 'SPF': 99, 'TA': 32768, 'A': 1, 'NXT': 30, 'AXFR': 252, 'RKEY': 57, 'KEY': 25, 'NIMLOC': 32, 'A6': 38, 'TLSA': 52, 'MG': 8, 'HIP': 55, 'NSEC': 47, 'GID': 102, 'SRV': 33, 'DLV': 32769, 'NSEC3PARAM': 51, 'UNSPEC': 103, 'TSIG': 250, 'ATMA': 34, 'RRSIG': 46, 'OPT': 41, 'MD': 3, 'NAPTR': 35, 'MF': 4, 'MB': 7, 'DHCID': 49, 'MX': 15, 'MAILB': 253, 'CERT': 37, 'NINFO': 56, 'APL': 42, 'MR': 9, 'SIG': 24, 'WKS': 11, 'KX': 36, 'NSAP': 22, 'RT': 21, 'SINK': 40}
@@ -13,105 +26,915 @@ ACTIONS = {1 : 'DROP', 2 : 'TC'}
 DROP_ACTION = 1
 TC_ACTION = 2
 
-# The interface on wich the filter will be attached 
+INV_ACTIONS = {v: k for k, v in ACTIONS.items()}
+# dnsdist dynamic block actions that can be enforced by the XDP program
+DYNBLOCK_ACTIONS = {'Drop': DROP_ACTION, 'Truncate': TC_ACTION}
+
+# The interface on wich the filter will be attached
 DEV = "eth0"
 
-# The list of blocked IPv4, IPv6 and QNames
-# IP format : (IPAddress, Action)
-# CIDR format : (IPAddress/cidr, Action)
-# QName format : (QName, QType, Action)
+# The list of blocked IPv4, IPv6 and QNames, used when no blocklist file is given
+# IP format : (IPAddress, Action)
+# CIDR format : (IPAddress/cidr, Action)
+# QName format : (QName, QType, Action)
 blocked_ipv4 = [("192.0.2.1", TC_ACTION)]
 blocked_ipv6 = [("2001:db8::1", TC_ACTION)]
 blocked_cidr4 = [("192.0.1.1/24", TC_ACTION)]
 blocked_cidr6 = [("2001:db8::1/128", TC_ACTION)]
 blocked_qnames = [("localhost", "A", DROP_ACTION), ("test.com", "*", TC_ACTION)]
 
+# The maps of xdp-filter.ebpf.src, and the packed layout of their keys:
+# - v4filter: the address as a host byte order uint32_t
+# - v6filter: the address, network byte order
+# - cidr4filter, cidr6filter: the prefix length as a uint32_t, followed by the
+#   network byte order address
+# - qnamefilter: the lowercase qname in wire format, zero-padded to 255 bytes,
+#   followed by the qtype as a uint16_t
+# Values are a uint64_t counter followed by the uint8_t action.
+MAPS = ('v4filter', 'v6filter', 'cidr4filter', 'cidr6filter', 'qnamefilter')
+PREFIX = struct.Struct('I')
+QNAME_KEY = struct.Struct('255sH')
+KEY_SIZES = {'v4filter': 4, 'v6filter': 16, 'cidr4filter': 8, 'cidr6filter': 20, 'qnamefilter': QNAME_KEY.size}
+VALUE = struct.Struct('QB7x')
+
+class Blocklist(object):
+  """
+  The entries to load into the maps: for each map, the packed keys in a
+  single buffer and the actions in an array, in the same order.
+  """
+
+  def __init__(self):
+    self.keys = {name: bytearray() for name in MAPS}
+    self.actions = {name: array.array('B') for name in MAPS}
+    self.errors = []
+    self.skipped = 0
+
+  def __len__(self):
+    return sum(len(actions) for actions in self.actions.values())
+
+  def getCount(self, name):
+    return len(self.actions[name])
+
+  def addEntries(self, lines, source='<list>'):
+    """
+    Parses lines of the form '<entry>[,<action>[,<qtype>]]' (commas and
+    whitespace are both accepted as separators), where entry is an IPv4 or
+    IPv6 address, a network in CIDR notation, or a qname. The action is DROP
+    or TC and defaults to DROP, the qtype only applies to qnames and defaults
+    to '*'. Empty lines and lines starting with '#' are skipped.
+    Entries are first sorted by kind, so that each kind can be converted in
+    bulk.
+    """
+    kinds = {name: [] for name in MAPS}
+    for lineno, line in enumerate(lines, 1):
+      fields = line.replace(',', ' ').split()
+      if not fields or fields[0].startswith('#'):
+        continue
+      entry = fields[0]
+      try:
+        action = INV_ACTIONS[fields[1].upper()] if len(fields) > 1 else DROP_ACTION
+      except KeyError:
+        self.errors.append(f"{source}:{lineno}: invalid action '{fields[1]}'")
+        continue
+      if '/' in entry:
+        name = 'cidr6filter' if ':' in entry else 'cidr4filter'
+      elif ':' in entry:
+        name = 'v6filter'
+      elif entry.replace('.', '').isdigit():
+        name = 'v4filter'
+      else:
+        name = 'qnamefilter'
+        entry = (entry, fields[2] if len(fields) > 2 else '*')
+      kinds[name].append((entry, action, source, lineno))
+
+    self.addAddresses('v4filter', socket.AF_INET, kinds['v4filter'])
+    self.addAddresses('v6filter', socket.AF_INET6, kinds['v6filter'])
+    self.addNetworks('cidr4filter', socket.AF_INET, kinds['cidr4filter'])
+    self.addNetworks('cidr6filter', socket.AF_INET6, kinds['cidr6filter'])
+    self.addQNames(kinds['qnamefilter'])
+
+  def addAddresses(self, name, family, entries):
+    if not entries:
+      return
+    try:
+      packed = b''.join([socket.inet_pton(family, entry) for entry, _, _, _ in entries])
+    except OSError:
+      # at least one invalid entry, sort them out one by one
+      valid = []
+      for item in entries:
+        try:
+          socket.inet_pton(family, item[0])
+          valid.append(item)
+        except OSError:
+          self.errors.append(f"{item[2]}:{item[3]}: invalid address '{item[0]}'")
+      entries = valid
+      packed = b''.join([socket.inet_pton(family, entry) for entry, _, _, _ in entries])
+
+    if family == socket.AF_INET:
+      # the v4filter key is the address in host byte order
+      values = array.array('I')
+      values.frombytes(packed)
+      if sys.byteorder == 'little':
+        values.byteswap()
+      packed = values.tobytes()
+    self.keys[name].extend(packed)
+    self.actions[name].extend([action for _, action, _, _ in entries])
+
+  def addNetworks(self, name, family, entries):
+    keys = self.keys[name]
+    actions = self.actions[name]
+    size = 4 if family == socket.AF_INET else 16
+    for entry, action, source, lineno in entries:
+      try:
+        (addr, prefix) = entry.split('/', 1)
+        prefix = int(prefix)
+        if prefix < 0 or prefix > size * 8:
+          raise ValueError
+        value = int.from_bytes(socket.inet_pton(family, addr), 'big')
+      except (OSError, ValueError):
+        self.errors.append(f"{source}:{lineno}: invalid network '{entry}'")
+        continue
+      value &= ((1 << (size * 8)) - 1) ^ ((1 << (size * 8 - prefix)) - 1)
+      keys.extend(PREFIX.pack(prefix))
+      keys.extend(value.to_bytes(size, 'big'))
+      actions.append(action)
+
+  def addQNames(self, entries):
+    keys = self.keys['qnamefilter']
+    actions = self.actions['qnamefilter']
+    for (qname, qtype), action, source, lineno in entries:
+      wire = toWireQName(qname)
+      if wire is None:
+        self.errors.append(f"{source}:{lineno}: invalid qname '{qname}'")
+        continue
+      if qtype.upper() not in QTYPES:
+        self.errors.append(f"{source}:{lineno}: invalid qtype '{qtype}'")
+        continue
+      keys.extend(QNAME_KEY.pack(wire, QTYPES[qtype.upper()]))
+      actions.append(action)
+
+  def getEntries(self, name):
+    """
+    Returns a dict of the packed keys of the given map to their action.
+    """
+    keys = self.keys[name]
+    size = KEY_SIZES[name]
+    return {bytes(keys[idx * size:(idx + 1) * size]): action for idx, action in enumerate(self.actions[name])}
+
+  def addPackedEntries(self, name, keys, actions):
+    self.keys[name].extend(keys)
+    self.actions[name].extend(actions)
+
+  def addFile(self, path):
+    with open(path, 'r') as fp:
+      self.addEntries(fp, path)
+
+  def addDynBlocks(self, dynblocks, source='<dynblocks>'):
+    """
+    Adds the dynamic blocks of a dnsdist dynblocklist export, as returned by
+    its /jsonstat?command=dynblocklist API endpoint: a JSON object of
+    netmasks or suffixes to their properties, including the action. Only
+    the Drop and Truncate actions can be enforced by the XDP program, the
+    other entries, and the warning-only ones which dnsdist merely logs, are
+    counted in skipped. Suffixes are blocked as exact qnames, the XDP
+    program not doing suffix matching.
+    """
+    lines = []
+    for entry, properties in dynblocks.items():
+      action = DYNBLOCK_ACTIONS.get(properties.get('action'))
+      if action is None or properties.get('warning') or entry == 'empty':
+        self.skipped += 1
+        continue
+      if entry.endswith('/32') and ':' not in entry:
+        entry = entry[:-3]
+      elif entry.endswith('/128'):
+        entry = entry[:-4]
+      lines.append(f"{entry} {ACTIONS[action]} *")
+    self.addEntries(lines, source)
+
+  def addDynBlocksFile(self, path):
+    with open(path, 'r') as fp:
+      try:
+        dynblocks = json.load(fp)
+      except ValueError as exp:
+        self.errors.append(f"{path}: invalid dynamic blocks export: {exp}")
+        return
+    self.addDynBlocks(dynblocks, path)
+
+  def addDefaultEntries(self):
+    self.addEntries([f"{ip} {ACTIONS[action]}" for ip, action in blocked_ipv4 + blocked_ipv6 + blocked_cidr4 + blocked_cidr6])
+    self.addEntries([f"{qname} {ACTIONS[action]} {qtype}" for qname, qtype, action in blocked_qnames])
+
+def toWireQName(qname):
+  """
+  Returns the lowercase wire format of qname, as the XDP program lowercases
+  the qname of the queries before looking them up, or None if it is invalid.
+  """
+  wire = bytearray()
+  for label in qname.lower().rstrip('.').split('.'):
+    if not label:
+      if qname.strip('.'):
+        return None
+      break
+    label = label.encode()
+    if len(label) > 63:
+      return None
+    wire.append(len(label))
+    wire.extend(label)
+  wire.append(0)
+  if len(wire) > 255:
+    return None
+  return bytes(wire)
+
+def getValues(actions):
+  """
+  Returns the packed values, counters set to 0, for the given actions.
+  """
+  values = bytearray(VALUE.size * len(actions))
+  values[8::VALUE.size] = actions.tobytes()
+  return values
+
+def updateMap(table, keys, values, count, batchSize):
+  """
+  Inserts or updates count entries from the packed keys and values into
+  table, by batches of batchSize entries if the kernel and bcc support it,
+  one at a time otherwise. table can be a bcc table or any object providing
+  the same Key and Leaf types, item assignment and, optionally,
+  items_update_batch(). Returns whether batches were used.
+  """
+  if not count:
+    return False
+  if ct.sizeof(table.Key) * count != len(keys) or ct.sizeof(table.Leaf) * count != len(values):
+    raise ValueError(f"Unexpected key or value size for {count} entries")
+
+  keySize = ct.sizeof(table.Key)
+  valueSize = ct.sizeof(table.Leaf)
+  batched = hasattr(table, 'items_update_batch')
+  start = 0
+  if batched:
+    try:
+      while start < count:
+        size = min(batchSize, count - start)
+        table.items_update_batch((table.Key * size).from_buffer(keys, start * keySize),
+                                 (table.Leaf * size).from_buffer(values, start * valueSize))
+        start += size
+    except Exception:
+      # not supported by this kernel or map type (LPM tries, for example),
+      # or the map is full: the remaining entries are inserted one at a time
+      batched = False
+
+  for idx in range(start, count):
+    table[table.Key.from_buffer(keys, idx * keySize)] = table.Leaf.from_buffer(values, idx * valueSize)
+  return batched
+
+def deleteFromMap(table, keys, count, batchSize):
+  """
+  Removes count entries, from the packed keys, from table, by batches if
+  possible. Keys not present in the table are ignored. Returns whether
+  batches were used.
+  """
+  if not count:
+    return False
+  keySize = ct.sizeof(table.Key)
+  batched = hasattr(table, 'items_delete_batch')
+  start = 0
+  if batched:
+    try:
+      while start < count:
+        size = min(batchSize, count - start)
+        table.items_delete_batch((table.Key * size).from_buffer(keys, start * keySize))
+        start += size
+    except Exception:
+      # not supported, or one of the keys is already gone
+      batched = False
+
+  for idx in range(start, count):
+    try:
+      del table[table.Key.from_buffer(keys, idx * keySize)]
+    except KeyError:
+      pass
+  return batched
+
+def getBatchesDescription(operation, count, batched, batchSize):
+  if not batched:
+    return f"{operation}: {count} single calls"
+  return f"{operation}: {(count + batchSize - 1) // batchSize} batch(es) of up to {batchSize} entries"
+
+def readMap(table):
+  """
+  Returns a dict of the packed keys of table to their (counter, action).
+  """
+  return {bytes(key): (leaf.counter, leaf.action) for key, leaf in table.items()}
+
+class MapReconciler(object):
+  """
+  Keeps the maps in sync with successive versions of the blocklist, by
+  applying only the differences between the last applied version and the
+  new one: inserts, deletes and action changes, the latter preserving the
+  counter of the entry. Entries already present in the maps when the
+  reconciler starts (restored from the pinned maps, or added by dnsdist)
+  are left alone unless they are part of the blocklist. Deletes are done
+  first so that a new version fitting in a nearly full map can replace the
+  previous one. When updating a map fails, for example because it is full,
+  the error is added to errors and the entries actually present are read
+  back, so that the next reconcile applies what is still missing.
+
+  The kernel offers no way to write only the action of an entry: an update
+  replaces the whole value, and bcc leaves are copies. Action changes are
+  therefore done one entry at a time, the counter being read right before
+  the value is written back, so that only the packets matched between these
+  two calls, a few microseconds, are not counted.
+  """
+
+  def __init__(self, tables, batchSize):
+    self._tables = tables
+    self._batchSize = batchSize
+    # entries managed by the reconciler, packed key to action
+    self._state = {name: {} for name in MAPS}
+    self._existing = {name: readMap(tables[name]) for name in MAPS}
+    self.errors = []
+
+  @staticmethod
+  def changeAction(table, key, action):
+    tableKey = table.Key.from_buffer_copy(key)
+    try:
+      leaf = table[tableKey]
+    except KeyError:
+      # removed behind our back
+      leaf = table.Leaf()
+    leaf.action = action
+    table[tableKey] = leaf
+
+  def reconcile(self, blocklist):
+    """
+    Applies the blocklist to the maps and returns, for every modified map, a
+    tuple of the numbers of inserted, deleted and changed entries, and a
+    description of the map calls used. The maps that could not be updated
+    are not part of the results but of errors.
+    """
+    results = {}
+    self.errors = []
+    for name in MAPS:
+      table = self._tables[name]
+      state = self._state[name]
+      existing = self._existing[name]
+      desired = blocklist.getEntries(name)
+
+      inserts = bytearray()
+      insertActions = array.array('B')
+      changes = []
+      for key, action in desired.items():
+        current = state.get(key)
+        if current == action:
+          continue
+        if current is None and key in existing:
+          current = existing.pop(key)[1]
+          if current == action:
+            continue
+        if current is None:
+          inserts.extend(key)
+          insertActions.append(action)
+          continue
+        changes.append((key, action))
+
+      deletes = bytearray()
+      for key in state:
+        if key not in desired:
+          deletes.extend(key)
+
+      size = KEY_SIZES[name]
+      counts = (len(insertActions), len(deletes) // size, len(changes))
+      try:
+        batchedDeletes = deleteFromMap(table, deletes, counts[1], self._batchSize)
+        for key, action in changes:
+          self.changeAction(table, key, action)
+        batched = updateMap(table, inserts, getValues(insertActions), counts[0], self._batchSize)
+      except Exception as exp:
+        self.errors.append(f"Error updating {name}: {exp}")
+        # only keep track of what actually made it to the map
+        self._state[name] = {key: action for key, (_, action) in readMap(table).items() if key in state or key in desired}
+        continue
+      if any(counts):
+        batches = []
+        if counts[0]:
+          batches.append(getBatchesDescription('inserts', counts[0], batched, self._batchSize))
+        if counts[2]:
+          batches.append(getBatchesDescription('action changes', counts[2], False, self._batchSize))
+        if counts[1]:
+          batches.append(getBatchesDescription('deletes', counts[1], batchedDeletes, self._batchSize))
+        results[name] = counts + (', '.join(batches),)
+      self._state[name] = desired
+
+    return results
+
+def readBlocklist(files, dynblockExports):
+  blocklist = Blocklist()
+  for path in files:
+    blocklist.addFile(path)
+  for path in dynblockExports:
+    blocklist.addDynBlocksFile(path)
+  return blocklist
+
+def getSourcesVersion(paths):
+  version = []
+  for path in paths:
+    try:
+      st = os.stat(path)
+      version.append((st.st_ino, st.st_size, st.st_mtime_ns))
+    except FileNotFoundError:
+      version.append(None)
+  return version
+
+def printReconcileResults(results):
+  for name, (inserted, deleted, changed, batches) in results.items():
+    print(f"- {name}: {inserted} inserted, {deleted} deleted, {changed} action changes ({batches})")
+
+def runReconciler(tables, files, dynblockExports, interval, batchSize):
+  """
+  Watches the blocklist files and dynamic blocks exports, and applies the
+  changes to the maps as soon as one of them is modified.
+  """
+  reconciler = MapReconciler(tables, batchSize)
+  paths = files + dynblockExports
+  version = None
+  while True:
+    current = getSourcesVersion(paths)
+    if current != version:
+      version = current
+      start = time.monotonic()
+      try:
+        blocklist = readBlocklist(files, dynblockExports)
+      except OSError as exp:
+        print(f"Error reading the blocklist, keeping the current entries: {exp}")
+        time.sleep(interval)
+        continue
+      parsed = time.monotonic()
+      results = reconciler.reconcile(blocklist)
+      done = time.monotonic()
+      for error in blocklist.errors:
+        print(error)
+      print(f"Reconciled {len(blocklist)} entries ({len(blocklist.errors)} invalid, {blocklist.skipped} skipped) in {(done - start) * 1000:.1f}ms (parsing {(parsed - start) * 1000:.1f}ms, maps {(done - parsed) * 1000:.1f}ms)")
+      printReconcileResults(results)
+      for error in reconciler.errors:
+        print(error)
+      if reconciler.errors:
+        # try again at the next interval, some room might have been made
+        version = None
+    time.sleep(interval)
+
+class DynBlockBridge(object):
+  """
+  Mirrors the dynamic blocks of a dnsdist instance, fetched from its web
+  API, into the maps. Every entry expires at the end of its block, even if
+  dnsdist can no longer be reached by then, and entries lifted early in
+  dnsdist are removed at the next successful poll.
+  """
+
+  def __init__(self, tables, url, apiKey, batchSize, timeout=2.0):
+    self._url = url.rstrip('/') + '/jsonstat?command=dynblocklist'
+    self._apiKey = apiKey
+    self._timeout = timeout
+    self._reconciler = MapReconciler(tables, batchSize)
+    # map name to {packed key: (action, expiry)}
+    self._entries = {name: {} for name in MAPS}
+    self.skipped = 0
+
+  def fetch(self):
+    headers = {'X-API-Key': self._apiKey} if self._apiKey else {}
+    request = urllib.request.Request(self._url, headers=headers)
+    with urllib.request.urlopen(request, timeout=self._timeout) as response:
+      return json.loads(response.read())
+
+  def setDynBlocks(self, dynblocks, now):
+    """
+    Replaces the current entries by the dynamic blocks. Warning-only blocks
+    are not enforced by dnsdist and are skipped, so that a block turning
+    into a warning one is removed. The others are grouped by expiry, dnsdist
+    usually inserting many of them at once with the same duration, so that
+    each group can be converted in bulk.
+    """
+    groups = {}
+    self.skipped = 0
+    for entry, properties in dynblocks.items():
+      if properties.get('warning'):
+        self.skipped += 1
+        continue
+      expiry = now + int(properties.get('seconds', 0))
+      groups.setdefault(expiry, {})[entry] = properties
+
+    entries = {name: {} for name in MAPS}
+    for expiry, group in groups.items():
+      blocklist = Blocklist()
+      blocklist.addDynBlocks(group, self._url)
+      for error in blocklist.errors:
+        print(error)
+      self.skipped += blocklist.skipped
+      for name in MAPS:
+        for key, action in blocklist.getEntries(name).items():
+          entries[name][key] = (action, expiry)
+    self._entries = entries
+
+  def expire(self, now):
+    for name in MAPS:
+      entries = self._entries[name]
+      for key in [key for key, (_, expiry) in entries.items() if expiry <= now]:
+        del entries[key]
+
+  def apply(self):
+    blocklist = Blocklist()
+    for name in MAPS:
+      entries = self._entries[name]
+      blocklist.addPackedEntries(name, b''.join(entries.keys()), array.array('B', [action for action, _ in entries.values()]))
+    results = self._reconciler.reconcile(blocklist)
+    # the failed updates are retried at the next poll
+    for error in self._reconciler.errors:
+      print(error)
+    return len(blocklist), results
+
+  def poll(self):
+    """
+    Fetches the dynamic blocks, then brings the maps up to date. Returns
+    the number of entries and the reconcile results.
+    """
+    try:
+      dynblocks = self.fetch()
+      self.setDynBlocks(dynblocks, time.time())
+    except (OSError, ValueError) as exp:
+      print(f"Error fetching the dynamic blocks from {self._url}, keeping the current entries until they expire: {exp}")
+    self.expire(time.time())
+    return self.apply()
+
+def runBridge(tables, url, apiKey, interval, batchSize):
+  bridge = DynBlockBridge(tables, url, apiKey, batchSize)
+  while True:
+    start = time.monotonic()
+    (count, results) = bridge.poll()
+    if results:
+      print(f"Applied {count} dynamic blocks ({bridge.skipped} skipped) in {(time.monotonic() - start) * 1000:.1f}ms")
+      printReconcileResults(results)
+    time.sleep(interval)
+
+def loadBlocklist(tables, blocklist, batchSize):
+  """
+  Loads the blocklist into the tables, a dict of map names to tables, and
+  prints a report of the time spent on each map.
+  """
+  for name in MAPS:
+    count = blocklist.getCount(name)
+    if not count:
+      continue
+    start = time.monotonic()
+    try:
+      batched = updateMap(tables[name], blocklist.keys[name], getValues(blocklist.actions[name]), count, batchSize)
+    except Exception as exp:
+      print(f"Error loading {name}: {exp}")
+      continue
+    elapsed = time.monotonic() - start
+    rate = count / elapsed if elapsed > 0 else 0
+    print(f"Loaded {count} entries into {name} in {elapsed:.3f}s ({rate:.0f} entries/s, {'batched' if batched else 'one at a time'})")
+
+def formatKey(name, key):
+  """
+  Returns a printable form of a packed key of the given map.
+  """
+  if name == 'v4filter':
+    return socket.inet_ntop(socket.AF_INET, struct.pack('!I', PREFIX.unpack(key)[0]))
+  if name == 'v6filter':
+    return socket.inet_ntop(socket.AF_INET6, key)
+  if name in ('cidr4filter', 'cidr6filter'):
+    family = socket.AF_INET if name == 'cidr4filter' else socket.AF_INET6
+    return f"{socket.inet_ntop(family, key[4:])}/{PREFIX.unpack_from(key)[0]}"
+  (wire, qtype) = QNAME_KEY.unpack(key)
+  labels = []
+  pos = 0
+  while pos < len(wire) and wire[pos]:
+    labels.append(wire[pos + 1:pos + 1 + wire[pos]].decode(errors='replace'))
+    pos += wire[pos] + 1
+  return f"{'.'.join(labels)}/{INV_QTYPES.get(qtype, qtype)}"
+
+def printCounters(tables):
+  for name in MAPS:
+    for key, leaf in tables[name].items():
+      print(f"{formatKey(name, bytes(key))} ({ACTIONS.get(leaf.action, leaf.action)}): {leaf.counter}")
+
+class MapSnapshot(object):
+  """
+  The content of a map at a given time: the packed keys in a single buffer,
+  and the counters and actions in arrays, in the same order.
+  """
+
+  def __init__(self, name, when, keys, counters, actions):
+    self.name = name
+    self.when = when
+    self.keys = keys
+    self.counters = counters
+    self.actions = actions
+
+  def __len__(self):
+    return len(self.counters)
+
+  def getKey(self, idx):
+    size = KEY_SIZES[self.name]
+    return self.keys[idx * size:(idx + 1) * size]
+
+  def getTotal(self, action):
+    # one byte per entry, set to 1 for the entries with that action
+    mask = self.actions.translate(bytes(1 if value == action else 0 for value in range(256)))
+    return sum(itertools.compress(self.counters, mask))
+
+  def getDeltas(self, previous):
+    """
+    Returns the increase of the counter of every entry since the previous
+    snapshot. Entries not present in the previous one are counted from 0.
+    """
+    if previous is None:
+      return list(self.counters)
+    if previous.keys == self.keys:
+      # same entries in the same order, by far the most common case
+      return list(map(operator.sub, self.counters, previous.counters))
+    size = KEY_SIZES[self.name]
+    keys = previous.keys
+    counters = {keys[idx * size:(idx + 1) * size]: counter for idx, counter in enumerate(previous.counters)}
+    return [max(counter - counters.get(self.getKey(idx), 0), 0) for idx, counter in enumerate(self.counters)]
+
+def lookupMapInBatches(table):
+  """
+  Reads the whole map with BPF_MAP_LOOKUP_BATCH calls into buffers
+  allocated once per table, without creating a Python object per entry.
+  Returns the number of entries and the keys and values buffers, or raises
+  OSError or AttributeError if batched lookups are not available.
+  """
+  from bcc.libbcc import lib
+
+  keySize = ct.sizeof(table.Key)
+  valueSize = ct.sizeof(table.Leaf)
+  capacity = table.max_entries
+  buffers = getattr(table, '_snapshotBuffers', None)
+  if buffers is None:
+    keysBuffer = bytearray(capacity * keySize)
+    valuesBuffer = bytearray(capacity * valueSize)
+    buffers = (keysBuffer, valuesBuffer, (ct.c_char * len(keysBuffer)).from_buffer(keysBuffer), (ct.c_char * len(valuesBuffer)).from_buffer(valuesBuffer))
+    table._snapshotBuffers = buffers
+  (keysBuffer, valuesBuffer, keys, values) = buffers
+
+  total = 0
+  inBatch = ct.c_uint32(0)
+  outBatch = ct.c_uint32(0)
+  first = True
+  while total < capacity:
+    count = ct.c_uint32(capacity - total)
+    res = lib.bpf_lookup_batch(table.map_fd, None if first else ct.byref(inBatch), ct.byref(outBatch),
+                               ct.byref(keys, total * keySize), ct.byref(values, total * valueSize), ct.byref(count))
+    err = ct.get_errno()
+    total += count.value
+    if res != 0:
+      if err == errno.ENOENT:
+        # no more entries
+        break
+      raise OSError(err, f"BPF_MAP_LOOKUP_BATCH has failed: {os.strerror(err)}")
+    inBatch.value = outBatch.value
+    first = False
+  return total, bytes(keysBuffer[:total * keySize]), memoryview(valuesBuffer)[:total * valueSize]
+
+def takeSnapshot(name, table):
+  when = time.monotonic()
+  try:
+    (count, keys, values) = lookupMapInBatches(table)
+    counters = array.array('Q', values.cast('Q')[::VALUE.size // 8])
+    actions = bytes(values[8::VALUE.size])
+    values.release()
+    return MapSnapshot(name, when, keys, counters, actions)
+  except (AttributeError, ImportError, OSError):
+    # no batched lookups for this map type (LPM tries, for example), kernel
+    # or bcc version, or not a bcc table
+    pass
+
+  keys = bytearray()
+  counters = array.array('Q')
+  actions = bytearray()
+  for key, leaf in table.items():
+    keys.extend(bytes(key))
+    counters.append(leaf.counter)
+    actions.append(leaf.action)
+  return MapSnapshot(name, when, bytes(keys), counters, bytes(actions))
+
+class CounterPoller(object):
+  """
+  Periodically snapshots the counters of the five maps, and computes the
+  match rate of every entry between two snapshots. The totals per map and
+  action, and the busiest entries, can be printed or served in the
+  Prometheus text format.
+  """
+
+  prefix = 'xdp_filter_'
+
+  def __init__(self, tables, interval, top, printReport):
+    self._tables = tables
+    self._interval = interval
+    self._top = top
+    self._printReport = printReport
+    self._lock = threading.Lock()
+    self._snapshots = {}
+    # map name to (entries, {action: total}, {action: rate}, poll duration)
+    self._stats = {}
+    self._busiest = []
+    self._server = None
+
+  def poll(self):
+    stats = {}
+    candidates = []
+    for name in MAPS:
+      start = time.monotonic()
+      snapshot = takeSnapshot(name, self._tables[name])
+      previous = self._snapshots.get(name)
+      deltas = snapshot.getDeltas(previous)
+      elapsed = snapshot.when - previous.when if previous else 0
+      self._snapshots[name] = snapshot
+
+      totals = {action: snapshot.getTotal(action) for action in ACTIONS}
+      rates = {}
+      for action in ACTIONS:
+        if previous is not None and elapsed > 0:
+          rates[action] = max(totals[action] - previous.getTotal(action), 0) / elapsed
+        else:
+          rates[action] = 0.0
+      if elapsed > 0:
+        for idx in heapq.nlargest(self._top, range(len(deltas)), key=deltas.__getitem__):
+          if deltas[idx] > 0:
+            candidates.append((deltas[idx] / elapsed, name, snapshot.getKey(idx), snapshot.actions[idx], snapshot.counters[idx]))
+      stats[name] = (len(snapshot), totals, rates, time.monotonic() - start)
+
+    busiest = heapq.nlargest(self._top, candidates, key=operator.itemgetter(0))
+    with self._lock:
+      self._stats = stats
+      self._busiest = busiest
+
+    if self._printReport:
+      self.report()
+
+  def run(self):
+    while True:
+      try:
+        self.poll()
+      except Exception as exp:
+        print(f"Error while polling the counters: {exp}")
+      time.sleep(self._interval)
+
+  def start(self):
+    thread = threading.Thread(name='Counter Poller', target=self.run)
+    thread.daemon = True
+    thread.start()
+
+  def report(self):
+    with self._lock:
+      stats = self._stats
+      busiest = self._busiest
+    datestr = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f"[{datestr}] Busiest entries:")
+    for name, (entries, totals, rates, duration) in stats.items():
+      ratesstr = ', '.join(f"{ACTIONS[action]} {rates[action]:.1f}/s" for action in ACTIONS)
+      print(f"- {name}: {entries} entries, {ratesstr}, polled in {duration * 1000:.1f}ms")
+    for rate, name, key, action, counter in busiest:
+      print(f"\t- {rate:.1f}/s ({counter}) {formatKey(name, key)} ({ACTIONS.get(action, action)})")
+
+  def startServer(self, addr, port):
+    poller = self
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path != '/metrics':
+          self.send_error(404)
+          return
+        content = poller.getMetrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+      def log_message(self, format, *args):
+        pass
+
+    try:
+      self._server = http.server.ThreadingHTTPServer((addr, port), MetricsHandler)
+    except OSError as exp:
+      sys.exit(f"Error while binding the metrics server: {exp}")
+    self._server.daemon_threads = True
+    thread = threading.Thread(name='Metrics Server', target=self._server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  @staticmethod
+  def getLabelValue(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+  def addMetric(self, lines, name, metricType, description, values):
+    name = self.prefix + name
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} {metricType}")
+    for labels, value in values:
+      labelsstr = ','.join(f'{label}="{self.getLabelValue(labelValue)}"' for label, labelValue in labels)
+      lines.append(f"{name}{{{labelsstr}}} {value}")
+
+  def getMetrics(self):
+    with self._lock:
+      stats = self._stats
+      busiest = self._busiest
+
+    lines = []
+    self.addMetric(lines, 'entries', 'gauge', 'Number of entries in the map',
+                   [((('map', name),), entries) for name, (entries, _, _, _) in stats.items()])
+    self.addMetric(lines, 'matches_total', 'counter', 'Sum of the counters of the entries of the map, by action',
+                   [((('map', name), ('action', ACTIONS[action])), total) for name, (_, totals, _, _) in stats.items() for action, total in totals.items()])
+    self.addMetric(lines, 'match_rate', 'gauge', 'Matches per second between the last two polls, by map and action',
+                   [((('map', name), ('action', ACTIONS[action])), f"{rate:.3f}") for name, (_, _, rates, _) in stats.items() for action, rate in rates.items()])
+    self.addMetric(lines, 'poll_duration_seconds', 'gauge', 'Time spent reading the counters of the map during the last poll',
+                   [((('map', name),), f"{duration:.6f}") for name, (_, _, _, duration) in stats.items()])
+    self.addMetric(lines, 'busiest_entry_rate', 'gauge', 'Matches per second of the busiest entries between the last two polls',
+                   [((('map', name), ('entry', formatKey(name, key)), ('action', ACTIONS.get(action, action))), f"{rate:.3f}") for rate, name, key, action, _ in busiest])
+    return '\n'.join(lines) + '\n'
+
 # Main
-xdp = BPF(src_file="xdp-filter.ebpf.src")
-
-fn = xdp.load_func("xdp_dns_filter", BPF.XDP)
-xdp.attach_xdp(DEV, fn, 0)
-
-v4filter = xdp.get_table("v4filter")
-v6filter = xdp.get_table("v6filter")
-cidr4filter = xdp.get_table("cidr4filter")
-cidr6filter = xdp.get_table("cidr6filter")
-qnamefilter = xdp.get_table("qnamefilter")
-
-for ip in blocked_ipv4:
-  print(f"Blocking {ip}")
-  key = v4filter.Key(int(netaddr.IPAddress(ip[0]).value))
-  leaf = v4filter.Leaf()
-  leaf.counter = 0
-  leaf.action = ip[1]
-  v4filter[key] = leaf
-
-for ip in blocked_ipv6:
-  print(f"Blocking {ip}")
-  ipv6_int = int(netaddr.IPAddress(ip[0]).value)
-  ipv6_bytes = bytearray([(ipv6_int & (255 << 8*(15-i))) >> (8*(15-i)) for i in range(16)])
-  key = (ct.c_uint8 * 16).from_buffer(ipv6_bytes)
-  leaf = v6filter.Leaf()
-  leaf.counter = 0
-  leaf.action = ip[1]
-  v6filter[key] = leaf
-
-for item in blocked_cidr4:
-  print(f"Blocking {item}")
-  key = cidr4filter.Key()
-  network = netaddr.IPNetwork(item[0])
-  key.cidr = network.prefixlen
-  key.addr = socket.htonl(network.network.value)
-  leaf = cidr4filter.Leaf()
-  leaf.counter = 0
-  leaf.action = item[1]
-  cidr4filter[key] = leaf
-
-for item in blocked_cidr6:
-  print(f"Blocking {item}")
-  key = cidr6filter.Key()
-  network = netaddr.IPNetwork(item[0])
-  key.cidr = network.prefixlen
-  ipv6_int = int(network.network.value)
-  ipv6_bytes = bytearray([(ipv6_int & (255 << 8*(15-i))) >> (8*(15-i)) for i in range(16)])
-  key.addr.in6_u.u6_addr8 = (ct.c_uint8 * 16).from_buffer(ipv6_bytes)
-  leaf = cidr6filter.Leaf()
-  leaf.counter = 0
-  leaf.action = item[1]
-  cidr6filter[key] = leaf
-
-for qname in blocked_qnames:
-  print(f"Blocking {qname}")
-  key = qnamefilter.Key()
-  qn = bytearray()
-  for sub in qname[0].split('.'):
-    qn.append(len(sub))
-    for ch in sub:
-      qn.append(ord(ch))
-  qn.extend((0,) * (255 - len(qn)))
-  key.qname = (ct.c_ubyte * 255).from_buffer(qn)
-  key.qtype = ct.c_uint16(QTYPES[qname[1]])
-  leaf = qnamefilter.Leaf()
-  leaf.counter = 0
-  leaf.action = qname[2]
-  qnamefilter[key] = leaf
-
-print("Filter is ready")
-try:
-  xdp.trace_print() 
-except KeyboardInterrupt:
-  pass
-
-for item in v4filter.items():
-  print(f"{str(netaddr.IPAddress(item[0].value))} ({ACTIONS[item[1].action]}): {item[1].counter}")
-for item in v6filter.items():
-  print(f"{str(socket.inet_ntop(socket.AF_INET6, item[0]))} ({ACTIONS[item[1].action]}): {item[1].counter}")
-for item in cidr4filter.items():
-  addr = netaddr.IPAddress(socket.ntohl(item[0].addr))
-  print(f"{str(addr)}/{str(item[0].cidr)} ({ACTIONS[item[1].action]}): {item[1].counter}")
-for item in cidr6filter.items():
-  print(f"{str(socket.inet_ntop(socket.AF_INET6, item[0].addr))}/{str(item[0].cidr)} ({ACTIONS[item[1].action]}): {item[1].counter}")
-for item in qnamefilter.items():
-  print(f"{''.join(map(chr, item[0].qname)).strip()}/{INV_QTYPES[item[0].qtype]} ({ACTIONS[item[1].action]}): {item[1].counter}")
-
-xdp.remove_xdp(DEV, 0)
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Attach the XDP DNS filter to an interface and fill its maps')
+  parser.add_argument('--interface', default=DEV, help='Interface to attach the filter to (default: %(default)s)')
+  parser.add_argument('--file', action='append', default=[],
+                      help="Blocklist file, one '<address, network or qname>[,<DROP|TC>[,<qtype>]]' entry per line. Can be repeated. The built-in lists are used when none is given")
+  parser.add_argument('--dynblock-export', action='append', default=[],
+                      help='JSON export of the dynamic blocks of dnsdist (/jsonstat?command=dynblocklist). Can be repeated')
+  parser.add_argument('--watch', action='store_true',
+                      help='Keep running, applying the changes made to the blocklist files and exports to the maps')
+  parser.add_argument('--watch-interval', type=float, default=1.0,
+                      help='Interval between two checks for changes with --watch, in seconds (default: %(default)s)')
+  parser.add_argument('--dnsdist-api',
+                      help='Base URL of the web server of a dnsdist instance (http://127.0.0.1:8083, for example) whose dynamic blocks are mirrored into the maps')
+  parser.add_argument('--dnsdist-api-key', help='API key of the dnsdist web server')
+  parser.add_argument('--dnsdist-interval', type=float, default=1.0,
+                      help='Interval between two fetches of the dnsdist dynamic blocks, in seconds (default: %(default)s)')
+  parser.add_argument('--poll-interval', type=float, default=10.0,
+                      help='Interval between two snapshots of the counters with --report or --prometheus-port, in seconds (default: %(default)s)')
+  parser.add_argument('--report', action='store_true',
+                      help='Print the match rates and the busiest entries after every snapshot of the counters')
+  parser.add_argument('--top', type=int, default=10,
+                      help='Number of busiest entries to report (default: %(default)s)')
+  parser.add_argument('--prometheus-port', type=int,
+                      help='Serve the match rates and busiest entries in the Prometheus format on that port, under /metrics')
+  parser.add_argument('--prometheus-address', default='127.0.0.1',
+                      help='Address to serve the Prometheus metrics on (default: %(default)s)')
+  parser.add_argument('--batch-size', type=int, default=10000,
+                      help='Maximum number of entries inserted by a single batched map update (default: %(default)s)')
+  parser.add_argument('--max-entries', type=int,
+                      help='Size of the maps, unless they already exist (pinned by dnsdist, for example). Defaults to 1024')
+  args = parser.parse_args()
+
+  if args.dnsdist_api:
+    if args.watch or args.file or args.dynblock_export:
+      sys.exit("--dnsdist-api can not be combined with --watch, --file or --dynblock-export")
+  elif args.watch:
+    if not args.file and not args.dynblock_export:
+      sys.exit("--watch requires at least one --file or --dynblock-export")
+  else:
+    start = time.monotonic()
+    try:
+      blocklist = readBlocklist(args.file, args.dynblock_export)
+    except OSError as exp:
+      sys.exit(f"Error reading the blocklist: {exp}")
+    if not args.file and not args.dynblock_export:
+      blocklist.addDefaultEntries()
+    for error in blocklist.errors:
+      print(error)
+    print(f"Parsed {len(blocklist)} entries ({len(blocklist.errors)} invalid, {blocklist.skipped} skipped) in {time.monotonic() - start:.3f}s")
+
+  from bcc import BPF
+
+  cflags = [f"-DMAX_ENTRIES={args.max_entries}"] if args.max_entries else []
+  xdp = BPF(src_file="xdp-filter.ebpf.src", cflags=cflags)
+
+  fn = xdp.load_func("xdp_dns_filter", BPF.XDP)
+  xdp.attach_xdp(args.interface, fn, 0)
+
+  tables = {name: xdp.get_table(name) for name in MAPS}
+
+  if args.report or args.prometheus_port:
+    poller = CounterPoller(tables, args.poll_interval, args.top, args.report)
+    if args.prometheus_port:
+      poller.startServer(args.prometheus_address, args.prometheus_port)
+    poller.start()
+
+  try:
+    if args.dnsdist_api:
+      print(f"Filter is ready, mirroring the dynamic blocks of {args.dnsdist_api}")
+      runBridge(tables, args.dnsdist_api, args.dnsdist_api_key, args.dnsdist_interval, args.batch_size)
+    elif args.watch:
+      print("Filter is ready, watching for blocklist changes")
+      runReconciler(tables, args.file, args.dynblock_export, args.watch_interval, args.batch_size)
+    else:
+      loadBlocklist(tables, blocklist, args.batch_size)
+      print("Filter is ready")
+      xdp.trace_print()
+  except KeyboardInterrupt:
+    pass
+
+  printCounters(tables)
+
+  xdp.remove_xdp(args.interface, 0)
@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+import concurrent.futures
+import os
 import socket
 import sys
 import threading
@@ -7,37 +9,143 @@ import time
 from atomicwrites import atomic_write
 
 class LookupThread(threading.Thread):
+    """
+    Resolves the targets concurrently, each one on its own schedule so that
+    a slow lookup does not hold the others back, and only rewrites the output
+    file when the results change. Every target is resolved again interval
+    seconds after its previous lookup completed: getaddrinfo does not expose
+    the TTL of the records, and the point is to notice address changes fast.
+    """
+
+    def __init__(self, fname, interval=1.0, workers=16, statsInterval=60.0):
+        super().__init__()
+        self.daemon = True
+        self.targets = []
+        self.fname = fname
+        self.interval = interval
+        self.workers = workers
+        self.statsInterval = statsInterval
+        self.ips = dict()
+        self.due = dict()
+        self.pending = dict()
+        self.output = None
+        # set when a lookup completes or the targets change
+        self.wakeup = threading.Event()
+        self.resetStats()
+
+    def setTargets(self, targets):
+        self.targets = targets
+        self.wakeup.set()
+
+    def resetStats(self):
+        self.statsStart = time.monotonic()
+        self.lookups = 0
+        self.failures = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+        self.slowest = None
+        self.rewrites = 0
+
+    @staticmethod
+    def resolve(target):
+        """
+        Returns the addresses of target, or None on a transient failure, and
+        the time the lookup took.
+        """
+        start = time.monotonic()
+        addrs = None
+        try:
+            res = socket.getaddrinfo(target, 0, proto=socket.IPPROTO_UDP)
+            addrs = [item[4][0] for item in res]
+        except socket.gaierror as e:
+            if e.errno in (socket.EAI_NODATA, socket.EAI_NONAME):
+                addrs = []
+        return addrs, time.monotonic() - start
+
+    def handleResult(self, target, future, now):
+        addrs, latency = future.result()
+        self.lookups += 1
+        self.totalLatency += latency
+        if latency > self.maxLatency:
+            self.maxLatency = latency
+            self.slowest = target
+        if addrs is None:
+            # keep the previous addresses, if any
+            self.failures += 1
+            addrs = self.ips.get(target, [])
+        self.ips[target] = addrs
+        self.due[target] = now + self.interval
+
+    def writeOutput(self, targets):
+        lines = ['return {\n']
+        for name in targets:
+            if name not in self.ips:
+                continue
+            lines.append('  ["{}"]='.format(name) + '{\n')
+            for addr in self.ips[name]:
+                lines.append('    "{}",\n'.format(addr))
+            lines.append('  },\n')
+        lines.append('}\n')
+        output = ''.join(lines)
+        if output == self.output:
+            return
+
+        with atomic_write(self.fname, overwrite=True) as out:
+            out.write(output)
+        self.output = output
+        self.rewrites += 1
+
+    def reportStats(self, now):
+        elapsed = now - self.statsStart
+        average = self.totalLatency / self.lookups if self.lookups else 0.0
+        print('dnsdist-resolver: {} lookups for {} targets in the last {:.0f}s, {} failures, latency avg {:.1f}ms max {:.1f}ms ({}), {} rewrites of {}'.format(
+            self.lookups, len(self.ips), elapsed, self.failures, average * 1000, self.maxLatency * 1000, self.slowest or 'none', self.rewrites, self.fname),
+              file=sys.stderr, flush=True)
+        self.resetStats()
+
     def run(self):
-        while True:
-            ips = dict()
-            for target in self.targets:
-                addrs = ips.get(target, [])
-
-                try:
-                    res = socket.getaddrinfo(target, 0, proto=socket.IPPROTO_UDP)
-                    addrs = [item[4][0] for item in res]
-                except socket.gaierror as e:
-                    if e.errno in (socket.EAI_NODATA, socket.EAI_NONAME):
-                        addrs = []
-
-                ips[target] = addrs
-
-            with atomic_write(self.fname, overwrite=True) as out:
-                out.write('return {\n')
-                for name,addrs in ips.items():
-                    out.write('  ["{}"]='.format(name) + '{\n')
-                    for addr in addrs:
-                        out.write('    "{}",\n'.format(addr))
-                    out.write('  },\n')
-                out.write('}\n')
-
-            time.sleep(1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                now = time.monotonic()
+                targets = self.targets
+                wanted = set(targets)
+                for target in list(self.ips):
+                    if target not in wanted:
+                        del self.ips[target]
+                        self.due.pop(target, None)
+
+                for target in targets:
+                    if target not in self.pending and self.due.get(target, 0) <= now:
+                        future = pool.submit(self.resolve, target)
+                        future.add_done_callback(lambda _: self.wakeup.set())
+                        self.pending[target] = future
+
+                # sleep until a lookup completes, the targets change, the
+                # next lookup is due or the stats have to be reported
+                deadlines = [due for target, due in self.due.items() if target not in self.pending]
+                if self.statsInterval:
+                    deadlines.append(self.statsStart + self.statsInterval)
+                timeout = max(0, min(deadlines) - now) if deadlines else None
+                self.wakeup.wait(timeout)
+                self.wakeup.clear()
+
+                now = time.monotonic()
+                for target, future in list(self.pending.items()):
+                    if future.done():
+                        del self.pending[target]
+                        if target in wanted:
+                            self.handleResult(target, future, now)
+
+                self.writeOutput(targets)
+
+                if self.statsInterval and now - self.statsStart >= self.statsInterval:
+                    self.reportStats(now)
 
 if __name__ == '__main__':
-    lt = LookupThread()
-    lt.setDaemon(True)
-    lt.targets = []
-    lt.fname = '/tmp/dnsdist-resolver.out'
+    lt = LookupThread('/tmp/dnsdist-resolver.out',
+                      interval=float(os.getenv('DNSDIST_RESOLVER_INTERVAL', '1')),
+                      workers=int(os.getenv('DNSDIST_RESOLVER_THREADS', '16')),
+                      statsInterval=float(os.getenv('DNSDIST_RESOLVER_STATS_INTERVAL', '60')))
     lt.start()
     for line in sys.stdin:
-        lt.targets=line.split()
+        lt.setTargets(line.split())
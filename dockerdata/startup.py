@@ -1,7 +1,13 @@
 #!/usr/bin/env -S python3 -u
+import hashlib
+import json
 import os
+import re
 import sys
-import jinja2
+import time
+
+start = time.monotonic()
+timings = []
 
 program = sys.argv[0].split('-')[0]
 product = os.path.basename(program)
@@ -44,24 +50,93 @@ setConsoleACL('0.0.0.0/0')
     templateroot = '/etc/dnsdist/templates.d'
     templatedestination = '/etc/dnsdist/conf.d'
 
+# Digests of the template and variables each file was rendered from, along
+# with the digest of the result, so that a restart with the same inputs
+# neither renders nor writes anything. The name does not end in .conf so it
+# is not picked up from the include directory.
+cachefile = os.path.join(templatedestination, '.startup-cache.json')
+cache = {}
+try:
+    with open(cachefile) as f:
+        cache = json.load(f)
+except (OSError, ValueError):
+    pass
+cacheChanged = False
+
+def getDigest(data):
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def getFileDigest(path):
+    try:
+        with open(path) as f:
+            return getDigest(f.read())
+    except OSError:
+        return None
+
+def getReferencedNames(source):
+    """
+    Returns the identifiers found in the {{ ... }} and {% ... %} blocks of
+    source, a superset of the variables the template can use, without having
+    to import jinja2.
+    """
+    names = set()
+    for block in re.findall(r'{{.*?}}|{%.*?%}', source, re.DOTALL):
+        names.update(re.findall(r'[A-Za-z_][A-Za-z0-9_]*', block))
+    return names
+
+def renderToFile(target, source, variables):
+    """
+    Renders source with variables into target, unless the cache says target
+    already holds the result of these exact inputs, and only writes target
+    when the rendered content differs from what it already contains. Only
+    the variables referenced by source are part of the inputs, the
+    environment holding per-container values like HOSTNAME.
+    """
+    global cacheChanged
+    stepStart = time.monotonic()
+    used = {name: variables.get(name) for name in getReferencedNames(source)}
+    inputs = getDigest(source + '\0' + json.dumps(used, sort_keys=True))
+    current = getFileDigest(target)
+    entry = cache.get(target)
+    if entry is not None and entry['inputs'] == inputs and entry['output'] == current:
+        print("{} is up to date".format(target))
+        timings.append(('{} (cached)'.format(os.path.basename(target)), time.monotonic() - stepStart))
+        return
+
+    import jinja2
+    rendered = jinja2.Template(source).render(variables)
+    output = getDigest(rendered)
+    if output != current:
+        with open(target, 'w') as f:
+            f.write(rendered)
+        print("Created {} with content:\n{}\n".format(target, rendered))
+    else:
+        print("{} is unchanged".format(target))
+    cache[target] = {'inputs': inputs, 'output': output}
+    cacheChanged = True
+    timings.append((os.path.basename(target), time.monotonic() - stepStart))
+
+timings.append(('setup', time.monotonic() - start))
+
 apikey = os.getenv(apienvvar)
 if apikey is not None:
-    webserver_conf = jinja2.Template(apiconftemplate).render(apikey=apikey)
-    conffile = os.path.join(templatedestination, '_api.conf')
-    with open(conffile, 'w') as f:
-        f.write(webserver_conf)
-    print("Created {} with content:\n{}\n".format(conffile, webserver_conf))
+    renderToFile(os.path.join(templatedestination, '_api.conf'), apiconftemplate, {'apikey': apikey})
 
 templates = os.getenv('TEMPLATE_FILES')
 if templates is not None:
     for templateFile in templates.split(','):
-        template = None
         with open(os.path.join(templateroot, templateFile + '.j2')) as f:
-            template = jinja2.Template(f.read())
-        rendered = template.render(os.environ)
-        target = os.path.join(templatedestination, templateFile + '.conf')
-        with open(target, 'w') as f:
-            f.write(rendered)
-        print("Created {} with content:\n{}\n".format(target, rendered))
+            source = f.read()
+        renderToFile(os.path.join(templatedestination, templateFile + '.conf'), source, dict(os.environ))
+
+if cacheChanged:
+    try:
+        with open(cachefile, 'w') as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print("Could not write the template cache {}: {}".format(cachefile, e))
+
+total = time.monotonic() - start
+print("Startup took {:.1f}ms ({})".format(total * 1000, ', '.join('{} {:.1f}ms'.format(name, elapsed * 1000) for name, elapsed in timings)))
 
 os.execv(program, [program]+args+sys.argv[1:])
@@ -15,6 +15,7 @@ import dns.message
 
 from pprint import pprint
 from eqdnsmessage import AssertEqualDNSMessageMixin
+from dnsseccache import runPdnsutil
 
 class AuthTest(AssertEqualDNSMessageMixin, unittest.TestCase):
     """
@@ -127,20 +128,21 @@ options {
                        bind_dnssec_db]
 
         print(' '.join(pdnsutilCmd))
-        try:
-            subprocess.check_output(pdnsutilCmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            raise AssertionError('%s failed (%d): %s' % (pdnsutilCmd, e.returncode, e.output))
+        runPdnsutil(bind_dnssec_db, ['create-bind-db'], pdnsutilCmd)
 
     @classmethod
     def secureZone(cls, confdir, zonename, key=None):
         zone = '.' if zonename == 'ROOT' else zonename
+        with open(os.path.join(confdir, '%s.zone' % zonename)) as zonefile:
+            zonecontent = zonefile.read()
         if not key:
+            step = ['secure-zone', zone, zonecontent]
             pdnsutilCmd = [os.environ['PDNSUTIL'],
                            '--config-dir=%s' % confdir,
                            'secure-zone',
                            zone]
         else:
+            step = ['import-zone-key', zone, zonecontent, key]
             keyfile = os.path.join(confdir, 'dnssec.key')
             with open(keyfile, 'w') as fdKeyfile:
                 fdKeyfile.write(key)
@@ -154,10 +156,7 @@ options {
                            'ksk']
 
         print(' '.join(pdnsutilCmd))
-        try:
-            subprocess.check_output(pdnsutilCmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            raise AssertionError('%s failed (%d): %s' % (pdnsutilCmd, e.returncode, e.output))
+        runPdnsutil(os.path.join(confdir, 'bind-dnssec.sqlite3'), step, pdnsutilCmd)
 
     @classmethod
     def generateAllAuthConfig(cls, confdir):
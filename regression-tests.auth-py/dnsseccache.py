@@ -0,0 +1 @@
+../regression-tests.common/dnsseccache.py
\ No newline at end of file
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+# Cache of the bind-dnssec databases produced by pdnsutil while setting up
+# the test auths. Each database is identified by the chain of steps that
+# produced it (create-bind-db, then one import-zone-key or secure-zone per
+# zone, with the zone contents and key material, and the pdns.conf pdnsutil
+# ran with, whose default-ksk-*/default-zsk-* settings select the generated
+# keys), starting from a digest of the pdnsutil binary so that a rebuilt
+# pdnsutil invalidates everything.
+# When the result of a step is already known it is copied in place instead
+# of running pdnsutil. Zones secured without a key then keep the keys that
+# were generated the first time.
+#
+# The cache lives in configs/dnssec-cache, PDNS_DNSSEC_CACHE_DIR can point
+# elsewhere or be set to an empty string to disable it.
+
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+_cacheDir = os.environ.get('PDNS_DNSSEC_CACHE_DIR', os.path.join('configs', 'dnssec-cache'))
+# FICLONE from linux/fs.h, to share the blocks of the copy on filesystems supporting it
+_FICLONE = 0x40049409
+_binaryDigests = {}
+# database path => (key of its content, digest of the file)
+_states = {}
+
+def _getBinaryDigest(command):
+    if command not in _binaryDigests:
+        digest = hashlib.sha256()
+        with open(shutil.which(command) or command, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+                digest.update(chunk)
+        _binaryDigests[command] = digest.hexdigest()
+    return _binaryDigests[command]
+
+def _getFileDigest(path):
+    try:
+        with open(path, 'rb') as fp:
+            return hashlib.sha256(fp.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+def _copy(src, dst):
+    with open(src, 'rb') as fdSrc, open(dst, 'wb') as fdDst:
+        try:
+            fcntl.ioctl(fdDst.fileno(), _FICLONE, fdSrc.fileno())
+        except OSError:
+            shutil.copyfileobj(fdSrc, fdDst)
+
+def _getConfigDigest(pdnsutilCmd):
+    """
+    Returns a digest of the pdns.conf in the --config-dir of pdnsutilCmd, with
+    that directory replaced by a placeholder so that identical settings
+    written to different directories match.
+    """
+    for arg in pdnsutilCmd:
+        if arg.startswith('--config-dir='):
+            confdir = arg[len('--config-dir='):]
+            break
+    else:
+        return None
+    try:
+        with open(os.path.join(confdir, 'pdns.conf')) as fp:
+            content = fp.read()
+    except FileNotFoundError:
+        return None
+    return hashlib.sha256(content.replace(confdir, '{confdir}').encode()).hexdigest()
+
+def _run(pdnsutilCmd):
+    try:
+        subprocess.check_output(pdnsutilCmd, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        raise AssertionError('%s failed (%d): %s' % (pdnsutilCmd, e.returncode, e.output))
+
+def runPdnsutil(dbpath, step, pdnsutilCmd):
+    """
+    Runs pdnsutilCmd, which changes the bind-dnssec database at dbpath, unless
+    the database resulting from applying step, a list of strings describing the
+    command and its inputs, to the current one is cached. A step starting with
+    'create-bind-db' starts a new chain.
+    """
+    if not _cacheDir:
+        _run(pdnsutilCmd)
+        return
+
+    if step[0] == 'create-bind-db':
+        previous = _getBinaryDigest(pdnsutilCmd[0])
+    else:
+        state = _states.get(dbpath)
+        if state is None or state[1] != _getFileDigest(dbpath):
+            # not created through the cache, or changed behind our back
+            _states.pop(dbpath, None)
+            _run(pdnsutilCmd)
+            return
+        previous = state[0]
+
+    digest = hashlib.sha256(previous.encode())
+    for part in step:
+        digest.update(b'\0' + part.encode())
+    digest.update(b'\0' + str(_getConfigDigest(pdnsutilCmd)).encode())
+    key = digest.hexdigest()
+    cached = os.path.join(_cacheDir, key + '.sqlite3')
+
+    if os.path.exists(cached):
+        _copy(cached, dbpath)
+    else:
+        if step[0] == 'create-bind-db' and os.path.exists(dbpath):
+            os.unlink(dbpath)
+        _run(pdnsutilCmd)
+        os.makedirs(_cacheDir, exist_ok=True)
+        # several test runs might share the cache
+        fd, tmpPath = tempfile.mkstemp(dir=_cacheDir)
+        os.close(fd)
+        _copy(dbpath, tmpPath)
+        os.replace(tmpPath, cached)
+
+    _states[dbpath] = (key, _getFileDigest(dbpath))
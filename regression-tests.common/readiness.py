@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+import atexit
+import errno
+import os
+import socket
+import subprocess
+import sys
+import time
+
+# Time actually spent waiting for daemons to start and stop, and the time the
+# fixed delays used before would have taken, reported when the suite exits.
+_waited = 0.0
+_fixedDelays = 0.0
+
+def _reportSavedTime():
+    if _fixedDelays:
+        print('Readiness probing: waited %.1fs instead of %.1fs of fixed delays, saving %.1fs' % (_waited, _fixedDelays, _fixedDelays - _waited), file=sys.stderr)
+
+atexit.register(_reportSavedTime)
+
+def _account(waited, fixedDelay):
+    global _waited, _fixedDelays
+    _waited += waited
+    _fixedDelays += fixedDelay
+
+def isListening(address, port):
+    """
+    Whether a TCP socket is listening on address and port, found by trying
+    to bind it ourselves so that nothing is sent to the daemon, which might
+    otherwise count the probe in its metrics or connection limits.
+    """
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    # connections in TIME_WAIT should not count as listening
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind((address, port))
+    except OSError as e:
+        if e.errno == errno.EADDRINUSE:
+            return True
+        raise
+    finally:
+        sock.close()
+    return False
+
+def isAnswering(address, port):
+    """
+    Whether something accepts TCP connections on address and port.
+    """
+    try:
+        sock = socket.create_connection((address, port), timeout=0.5)
+    except OSError:
+        return False
+    sock.close()
+    return True
+
+def getThreadNames(pid):
+    """
+    Returns the names of the threads of pid, or None if they cannot be
+    listed, for example on a system without /proc.
+    """
+    names = set()
+    try:
+        for task in os.listdir('/proc/%d/task' % (pid)):
+            with open('/proc/%d/task/%s/comm' % (pid, task)) as fp:
+                names.add(fp.read().strip())
+    except OSError:
+        return None
+    return names
+
+def dumpLog(logFile):
+    if logFile is None:
+        return
+    print("\n*** Log of %s ***" % (logFile))
+    with open(logFile, 'r') as fdLog:
+        print(fdLog.read())
+    print("*** End of log of %s ***" % (logFile))
+
+def waitForReadiness(process, listening=[], answering=[], logFile=None, timeout=10.0, fixedDelay=0.0, ready=None):
+    """
+    Polls, with a short backoff, until every (address, port) of listening
+    has a listening socket and every one of answering accepts connections,
+    then until ready, if set, returns True. Returns early if process exits,
+    leaving it to the caller to deal with, and raises an AssertionError
+    after timeout seconds. fixedDelay is the time the caller used to sleep
+    instead, for the report.
+    """
+    start = time.monotonic()
+    pending = [(isListening, address, port) for address, port in listening] + [(isAnswering, address, port) for address, port in answering]
+    delay = 0.01
+    while pending or ready is not None:
+        if process.poll() is not None:
+            dumpLog(logFile)
+            break
+        pending = [(probe, address, port) for probe, address, port in pending if not probe(address, port)]
+        if not pending and (ready is None or ready()):
+            break
+        if time.monotonic() - start > timeout:
+            dumpLog(logFile)
+            waitingFor = ', '.join('%s:%d' % (address, port) for _, address, port in pending) or 'the end of its initialization'
+            raise AssertionError('%s is not ready after %.1fs, still waiting for %s' % (process.args[0], timeout, waitingFor))
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+
+    waited = time.monotonic() - start
+    _account(waited, fixedDelay)
+    return waited
+
+def waitForExit(process, timeout=10.0, fixedDelay=0.0):
+    """
+    Terminates process and waits for it to exit, killing it if it is still
+    there after timeout seconds.
+    """
+    start = time.monotonic()
+    try:
+        process.terminate()
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            print("kill...", process, file=sys.stderr)
+            process.kill()
+            process.wait()
+    except OSError as e:
+        # the process might already be gone
+        if e.errno != errno.ESRCH:
+            raise
+
+    waited = time.monotonic() - start
+    _account(waited, fixedDelay)
+    return waited
@@ -1,7 +1,9 @@
 #!/usr/bin/env python2
 
+import asyncio
 import copy
 import os
+import re
 import socket
 import ssl
 import struct
@@ -25,6 +27,7 @@ import h2.config
 
 from eqdnsmessage import AssertEqualDNSMessageMixin
 from proxyprotocol import ProxyProtocol
+from readiness import getThreadNames, waitForExit, waitForReadiness
 
 # Python2/3 compatibility hacks
 try:
@@ -37,6 +40,50 @@ try:
 except NameError:
   pass
 
+# When the tests are split over several worker processes, see runparallel.py,
+# each worker gets its own block of ports below the ephemeral range and its own
+# configuration directory. Every '_*Port*' attribute of the test classes is then
+# mapped to a port of that block when the class is defined, the same original
+# port always getting the same one, so classes sharing a port still do, and the
+# ports in their '_*URL' attributes are updated accordingly.
+_worker = os.environ.get('DNSDIST_TEST_WORKER')
+_workers = int(os.environ.get('DNSDIST_TEST_WORKERS', '1'))
+_firstWorkerPort = 11000
+_lastWorkerPort = 32767
+_portsMapping = {}
+if _worker is not None:
+    _worker = int(_worker)
+    _portsBlockSize = (_lastWorkerPort - _firstWorkerPort + 1) // _workers
+    _nextPort = _firstWorkerPort + _worker * _portsBlockSize
+    _configDir = os.path.join('configs', 'worker-%d' % (_worker))
+    os.makedirs(_configDir, exist_ok=True)
+else:
+    _configDir = 'configs'
+
+def _allocatePort(port):
+    global _nextPort
+    if port in _portsMapping:
+        return _portsMapping[port]
+    if port in _portsMapping.values():
+        # already allocated, for example copied from another class
+        return port
+    if _nextPort >= _firstWorkerPort + (_worker + 1) * _portsBlockSize:
+        raise AssertionError('Worker %d ran out of ports' % (_worker))
+    _portsMapping[port] = _nextPort
+    _nextPort += 1
+    return _portsMapping[port]
+
+def _allocatePorts(cls):
+    if _worker is None:
+        return
+    for name, value in list(vars(cls).items()):
+        if re.match(r'^_\w*Port\w*$', name) and isinstance(value, int) and not isinstance(value, bool):
+            setattr(cls, name, _allocatePort(value))
+    # URLs like _dohBaseURL are built from the original ports in the class body
+    for name, value in list(vars(cls).items()):
+        if name.startswith('_') and name.endswith('URL') and isinstance(value, str):
+            setattr(cls, name, re.sub(r':(\d+)(?=/|$)', lambda match: ':%d' % (_portsMapping.get(int(match.group(1)), int(match.group(1)))), value))
+
 
 class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
     """
@@ -53,7 +100,10 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
     _toResponderQueue = Queue()
     _fromResponderQueue = Queue()
     _queueTimeout = 1
+    # time to wait for dnsdist to start when it has no known port to probe
     _dnsdistStartupDelay = 2.0
+    # maximum time to wait for the ports to be probed
+    _dnsdistStartupTimeout = 10.0
     _dnsdist = None
     _responsesCounter = {}
     _config_template = """
@@ -68,11 +118,27 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
     _checkConfigExpectedOutput = None
     _verboseMode = False
     _skipListeningOnCL = False
+    # 'threads' or 'asyncio', see AsyncResponder
+    _responderBackend = 'threads'
+    # wire-format responses answered by the asyncio responder without
+    # parsing the queries, see buildResponseTable
+    _responseTable = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _allocatePorts(cls)
 
     @classmethod
     def startResponders(cls):
         print("Launching responders..")
 
+        if cls._responderBackend == 'asyncio':
+            cls._UDPResponder = threading.Thread(name='Asyncio Responder', target=cls.AsyncResponder, args=[cls._testServerPort, cls._toResponderQueue, cls._fromResponderQueue], kwargs={'responseTable': cls._responseTable})
+            cls._UDPResponder.setDaemon(True)
+            cls._UDPResponder.start()
+            cls._TCPResponder = cls._UDPResponder
+            return
+
         cls._UDPResponder = threading.Thread(name='UDP Responder', target=cls.UDPResponder, args=[cls._testServerPort, cls._toResponderQueue, cls._fromResponderQueue])
         cls._UDPResponder.setDaemon(True)
         cls._UDPResponder.start()
@@ -83,7 +149,7 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
     @classmethod
     def startDNSDist(cls):
         print("Launching dnsdist..")
-        confFile = os.path.join('configs', 'dnsdist_%s.conf' % (cls.__name__))
+        confFile = os.path.join(_configDir, 'dnsdist_%s.conf' % (cls.__name__))
         params = tuple([getattr(cls, param) for param in cls._config_params])
         print(params)
         with open(confFile, 'w') as conf:
@@ -111,13 +177,13 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
         except subprocess.CalledProcessError as exc:
             raise AssertionError('dnsdist --check-config failed (%d): %s' % (exc.returncode, exc.output))
         if cls._checkConfigExpectedOutput is not None:
-          expectedOutput = cls._checkConfigExpectedOutput
+          expectedOutput = cls.getWorkerOutput(cls._checkConfigExpectedOutput)
         else:
           expectedOutput = ('Configuration \'%s\' OK!\n' % (confFile)).encode()
         if not cls._verboseMode and output != expectedOutput:
             raise AssertionError('dnsdist --check-config failed: %s' % output)
 
-        logFile = os.path.join('configs', 'dnsdist_%s.log' % (cls.__name__))
+        logFile = os.path.join(_configDir, 'dnsdist_%s.log' % (cls.__name__))
         with open(logFile, 'w') as fdLog:
           cls._dnsdist = subprocess.Popen(dnsdistcmd, close_fds=True, stdout=fdLog, stderr=fdLog)
 
@@ -126,12 +192,65 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
         else:
             delay = cls._dnsdistStartupDelay
 
-        time.sleep(delay)
+        listening, answering = cls.getReadinessAddresses()
+        if listening or answering:
+            waitForReadiness(cls._dnsdist, listening, answering, logFile, timeout=max(cls._dnsdistStartupTimeout, delay), fixedDelay=delay, ready=cls.isDNSDistInitialized)
+        else:
+            time.sleep(delay)
 
         if cls._dnsdist.poll() is not None:
             cls._dnsdist.kill()
             sys.exit(cls._dnsdist.returncode)
 
+    @classmethod
+    def getWorkerOutput(cls, output):
+        """
+        Adapts an expected dnsdist output mentioning the configuration
+        directory or ports to the ones of the current worker, if any.
+        """
+        if _worker is None:
+            return output
+        output = output.replace(b"'configs/", ("'%s/" % (_configDir)).encode())
+        for original, allocated in _portsMapping.items():
+            output = output.replace(('127.0.0.1:%d' % (original)).encode(), ('127.0.0.1:%d' % (allocated)).encode())
+        return output
+
+    @classmethod
+    def getReadinessAddresses(cls):
+        """
+        Returns the addresses dnsdist should be listening on, probed without
+        sending anything to them, and the console and web server ones, which
+        should accept connections, once it is started.
+        """
+        listening = []
+        answering = []
+        if not cls._skipListeningOnCL or '_dnsDistPort' in cls._config_params:
+            address = cls._dnsDistListeningAddr
+            if address == '0.0.0.0':
+                address = '127.0.0.1'
+            listening.append((address, cls._dnsDistPort))
+        for param in ['_tlsServerPort', '_dohServerPort']:
+            if param in cls._config_params:
+                listening.append(('127.0.0.1', getattr(cls, param)))
+        for param in ['_consolePort', '_webServerPort']:
+            if param in cls._config_params:
+                answering.append(('127.0.0.1', getattr(cls, param)))
+        return listening, answering
+
+    @classmethod
+    def isDNSDistInitialized(cls):
+        """
+        Whether dnsdist is done with the initial health checks of its
+        backends, which it runs after binding its sockets but before starting
+        the frontends then the health checks thread. Assumed to be done when
+        its threads cannot be listed, for example when it runs under a
+        wrapper like valgrind.
+        """
+        names = getThreadNames(cls._dnsdist.pid)
+        if names is None or not any(name.startswith('dnsdist') for name in names):
+            return True
+        return 'dnsdist/healthC' in names
+
     @classmethod
     def setUpSockets(cls):
         print("Setting up UDP socket..")
@@ -155,22 +274,19 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
         else:
             delay = 1.0
         if cls._dnsdist:
-            cls._dnsdist.terminate()
-            if cls._dnsdist.poll() is None:
-                time.sleep(delay)
-                if cls._dnsdist.poll() is None:
-                    cls._dnsdist.kill()
-                cls._dnsdist.wait()
+            waitForExit(cls._dnsdist, timeout=delay, fixedDelay=delay)
 
     @classmethod
-    def _ResponderIncrementCounter(cls):
-        if threading.currentThread().name in cls._responsesCounter:
-            cls._responsesCounter[threading.currentThread().name] += 1
+    def _ResponderIncrementCounter(cls, name=None):
+        if name is None:
+            name = threading.currentThread().name
+        if name in cls._responsesCounter:
+            cls._responsesCounter[name] += 1
         else:
-            cls._responsesCounter[threading.currentThread().name] = 1
+            cls._responsesCounter[name] = 1
 
     @classmethod
-    def _getResponse(cls, request, fromQueue, toQueue, synthesize=None):
+    def _getResponse(cls, request, fromQueue, toQueue, synthesize=None, counterName=None):
         response = None
         if len(request.question) != 1:
             print("Skipping query with question count %d" % (len(request.question)))
@@ -180,7 +296,7 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
             cls._healthCheckCounter += 1
             response = dns.message.make_response(request)
         else:
-            cls._ResponderIncrementCounter()
+            cls._ResponderIncrementCounter(counterName)
             if not fromQueue.empty():
                 toQueue.put(request, True, cls._queueTimeout)
                 response = fromQueue.get(True, cls._queueTimeout)
@@ -336,6 +452,155 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
 
         sock.close()
 
+    @staticmethod
+    def buildResponseTable(responses):
+        """
+        Turns a list of dns.message responses into a table usable by
+        AsyncResponder, keyed on the lowercased wire-format qname and qtype
+        of their question.
+        """
+        table = {}
+        for response in responses:
+            question = response.question[0]
+            table[(question.name.to_wire().lower(), question.rdtype)] = response.to_wire(max_size=65535)
+        return table
+
+    @staticmethod
+    def _getRawQuestion(data):
+        """
+        Returns the lowercased wire-format qname and the qtype of a query
+        without parsing it, or None if there is not exactly one question.
+        Queries do not use compression so the qname ends at the first empty label.
+        """
+        if len(data) < 17 or data[4:6] != b'\x00\x01':
+            return None
+        pos = 12
+        end = len(data)
+        while pos < end:
+            labelLen = data[pos]
+            if labelLen == 0:
+                break
+            if labelLen > 63:
+                return None
+            pos += labelLen + 1
+        if pos + 3 > end:
+            return None
+        return (data[12:pos + 1].lower(), (data[pos + 1] << 8) | data[pos + 2])
+
+    @classmethod
+    def _getAsyncResponse(cls, data, fromQueue, toQueue, trailingDataResponse, callback, responseTable, counterName, maxSize):
+        """
+        Returns the request, if it had to be parsed, and the wire-format response to
+        data, following the same rules as UDPResponder and handleTCPConnection.
+        """
+        if responseTable:
+            question = cls._getRawQuestion(data)
+            if question is not None:
+                wire = responseTable.get(question)
+                if wire is not None:
+                    cls._ResponderIncrementCounter(counterName)
+                    # copy the ID and the question, to preserve the case of the qname
+                    questionEnd = 12 + len(question[0]) + 4
+                    return None, data[0:2] + wire[2:12] + data[12:questionEnd] + wire[questionEnd:]
+
+        ignoreTrailing = trailingDataResponse is True
+        forceRcode = None
+        try:
+            request = dns.message.from_wire(data, ignore_trailing=ignoreTrailing)
+        except dns.message.TrailingJunk as e:
+            if trailingDataResponse is False:
+                raise
+            print("%s query with trailing data, synthesizing response" % (counterName.split()[0]))
+            request = dns.message.from_wire(data, ignore_trailing=True)
+            forceRcode = trailingDataResponse
+
+        if callback:
+            return request, callback(request)
+
+        # the queues are not bounded and _getResponse only waits on fromQueue
+        # when it is not empty, so this does not block the event loop
+        response = cls._getResponse(request, fromQueue, toQueue, synthesize=forceRcode, counterName=counterName)
+        if not response:
+            return request, None
+        return request, response.to_wire(max_size=maxSize)
+
+    @classmethod
+    def AsyncResponder(cls, port, fromQueue, toQueue, trailingDataResponse=False, multipleResponses=False, callback=None, responseTable=None, listeningAddr='127.0.0.1', udpName='UDP Responder', tcpName='TCP Responder'):
+        """
+        Serves both UDP and TCP on port from a single asyncio event loop,
+        to be run in its own thread like UDPResponder and TCPResponder.
+        The trailingDataResponse, multipleResponses and callback parameters
+        behave as they do for these, and the responses are counted under
+        udpName and tcpName. Queries matching an entry of responseTable,
+        built by buildResponseTable, are answered from it without being
+        parsed, and without going through the queues nor the callback.
+        Unlike TCPResponder, several queries can be sent over the same TCP
+        connection, except when multipleResponses is set.
+        """
+
+        class UDPProtocol(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, addr):
+                try:
+                    _, wire = cls._getAsyncResponse(data, fromQueue, toQueue, trailingDataResponse, callback, responseTable, udpName, 65535)
+                except dns.exception.DNSException as e:
+                    print('Error in the asyncio UDP responder: %s' % (str(e)))
+                    return
+                if wire:
+                    self.transport.sendto(wire, addr)
+
+        async def handleTCPConnection(reader, writer):
+            try:
+                while True:
+                    data = await reader.readexactly(2)
+                    (datalen,) = struct.unpack("!H", data)
+                    data = await reader.readexactly(datalen)
+                    _, wire = cls._getAsyncResponse(data, fromQueue, toQueue, trailingDataResponse, callback, responseTable, tcpName, 65535)
+                    if not wire:
+                        break
+
+                    writer.write(struct.pack("!H", len(wire)) + wire)
+                    if multipleResponses:
+                        # the query is not parsed when answered from responseTable
+                        (queryID,) = struct.unpack("!H", data[0:2])
+                        while not fromQueue.empty():
+                            response = fromQueue.get(False)
+                            if not response:
+                                break
+                            response = copy.copy(response)
+                            response.id = queryID
+                            wire = response.to_wire(max_size=65535)
+                            writer.write(struct.pack("!H", len(wire)) + wire)
+                        await writer.drain()
+                        break
+
+                    await writer.drain()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            except dns.exception.DNSException as e:
+                print('Error in the asyncio TCP responder: %s' % (str(e)))
+            finally:
+                writer.close()
+
+        async def serve():
+            loop = asyncio.get_running_loop()
+            udpSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udpSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            udpSock.bind((listeningAddr, port))
+            await loop.create_datagram_endpoint(UDPProtocol, sock=udpSock)
+
+            tcpSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            tcpSock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            tcpSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            tcpSock.bind((listeningAddr, port))
+            server = await asyncio.start_server(handleTCPConnection, sock=tcpSock, backlog=100)
+            async with server:
+                await server.serve_forever()
+
+        asyncio.run(serve())
+
     @classmethod
     def handleDoHConnection(cls, config, conn, fromQueue, toQueue, trailingDataResponse, multipleResponses, callback, tlsContext, useProxyProtocol):
         ignoreTrailing = trailingDataResponse is True
@@ -843,3 +1108,6 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
         proxy.values.sort()
         values.sort()
         self.assertEqual(proxy.values, values)
+
+# the ports of the subclasses are mapped by __init_subclass__
+_allocatePorts(DNSDistTest)
@@ -0,0 +1 @@
+../regression-tests.common/readiness.py
\ No newline at end of file
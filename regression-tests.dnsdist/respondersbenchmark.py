@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Compares how many UDP queries per second the threaded responder of
+# DNSDistTest and the asyncio one, with and without a response table,
+# can answer. No dnsdist is involved, the queries are sent directly
+# to the responders.
+
+import argparse
+import socket
+import threading
+import time
+
+import dns.message
+import dns.rrset
+
+from dnsdisttests import DNSDistTest, Queue
+
+def generateQueries(count):
+    queries = []
+    responses = []
+    for idx in range(count):
+        query = dns.message.make_query('host%d.responders.bench.tests.powerdns.com.' % (idx), 'A', 'IN')
+        response = dns.message.make_response(query)
+        response.answer.append(dns.rrset.from_text(query.question[0].name, 60, 'IN', 'A', '192.0.2.%d' % (idx % 254 + 1)))
+        queries.append(query.to_wire())
+        responses.append(response)
+    return queries, responses
+
+def startResponder(name, port, responseTable):
+    if name == 'threads':
+        target = DNSDistTest.UDPResponder
+        args = [port, Queue(), Queue()]
+        kwargs = {}
+    else:
+        target = DNSDistTest.AsyncResponder
+        args = [port, Queue(), Queue()]
+        kwargs = {'responseTable': responseTable}
+    thread = threading.Thread(name='UDP Responder', target=target, args=args, kwargs=kwargs)
+    thread.daemon = True
+    thread.start()
+    # wait for the responder to be listening
+    time.sleep(0.5)
+
+def run(port, queries, total, window):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(1.0)
+    sock.connect(('127.0.0.1', port))
+    sent = 0
+    received = 0
+    start = time.monotonic()
+    while sent < min(window, total):
+        sock.send(queries[sent % len(queries)])
+        sent += 1
+    while received < total:
+        try:
+            sock.recv(4096)
+        except socket.timeout:
+            # lost, keep the window full
+            sent -= 1
+        else:
+            received += 1
+        if sent < total:
+            sock.send(queries[sent % len(queries)])
+            sent += 1
+    elapsed = time.monotonic() - start
+    sock.close()
+    return received, elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the threaded and asyncio responders of dnsdisttests.py')
+    parser.add_argument('--queries', type=int, default=50000,
+                        help='Number of queries to send to each responder (default: %(default)s)')
+    parser.add_argument('--names', type=int, default=1000,
+                        help='Number of distinct names queried (default: %(default)s)')
+    parser.add_argument('--window', type=int, default=64,
+                        help='Number of queries in flight (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=5390,
+                        help='First port to listen on, one per responder (default: %(default)s)')
+    args = parser.parse_args()
+
+    queries, responses = generateQueries(args.names)
+    responseTable = DNSDistTest.buildResponseTable(responses)
+
+    # the threaded and asyncio responders without a table answer SERVFAIL
+    # since nothing is queued, but they still parse every query
+    port = args.port
+    for label, backend, table in (('threads', 'threads', None), ('asyncio', 'asyncio', None), ('asyncio + response table', 'asyncio', responseTable)):
+        startResponder(backend, port, table)
+        received, elapsed = run(port, queries, args.queries, args.window)
+        print('%s: %d responses in %.2fs, %.0f qps' % (label, received, elapsed, received / elapsed))
+        port += 1
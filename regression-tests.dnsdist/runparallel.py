@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# Runs the test modules in several nosetests worker processes, each one
+# getting its own ports and configuration directory from dnsdisttests.py,
+# then the modules that cannot be moved to other ports one after the other.
+
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import time
+
+# These modules use ports outside of the '_*Port*' class attributes, for
+# example in responders started at import time or in expected values, or
+# regenerate the certificate and key used by the other modules.
+serialModules = [
+    'test_BackendDiscovery.py',
+    'test_OCSP.py',
+    'test_OOOR.py',
+    'test_ProxyProtocol.py',
+    'test_TLS.py',
+]
+
+def splitModules(modules, workers):
+    """
+    Spreads the modules over the workers, the largest ones first, using
+    their size as an estimate of how long they take to run.
+    """
+    buckets = [[] for _ in range(workers)]
+    sizes = [0] * workers
+    for module in sorted(modules, key=os.path.getsize, reverse=True):
+        idx = sizes.index(min(sizes))
+        buckets[idx].append(module)
+        sizes[idx] += os.path.getsize(module)
+    return buckets
+
+def startWorker(worker, workers, modules):
+    env = dict(os.environ)
+    env['DNSDIST_TEST_WORKER'] = str(worker)
+    env['DNSDIST_TEST_WORKERS'] = str(workers)
+    configDir = os.path.join('configs', 'worker-%d' % (worker))
+    os.makedirs(configDir, exist_ok=True)
+    logFile = os.path.join(configDir, 'nosetests.log')
+    cmd = ['nosetests', '--with-xunit', '--xunit-file=nosetests-worker-%d.xml' % (worker)] + modules
+    with open(logFile, 'w') as fdLog:
+        process = subprocess.Popen(cmd, env=env, stdout=fdLog, stderr=subprocess.STDOUT, close_fds=True)
+    return process, logFile
+
+def dumpLogs(pattern):
+    for log in sorted(glob.glob(pattern)):
+        print('=== %s ===' % (log))
+        with open(log) as fdLog:
+            print(fdLog.read())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the dnsdist regression tests in parallel')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes (default: %(default)s)')
+    parser.add_argument('modules', nargs='*',
+                        help='Test modules to run (default: all of them)')
+    args = parser.parse_args()
+
+    modules = args.modules or sorted(glob.glob('test_*.py'))
+    serial = [module for module in modules if os.path.basename(module) in serialModules]
+    parallel = [module for module in modules if module not in serial]
+    workers = max(1, min(args.workers, len(parallel)))
+
+    start = time.monotonic()
+    processes = []
+    for worker, bucket in enumerate(splitModules(parallel, workers)):
+        if bucket:
+            processes.append((worker,) + startWorker(worker, workers, bucket))
+
+    failed = False
+    for worker, process, logFile in processes:
+        if process.wait() != 0:
+            failed = True
+            print('=== worker %d failed ===' % (worker))
+            dumpLogs(os.path.join('configs', 'worker-%d' % (worker), '*.log'))
+        else:
+            with open(logFile) as fdLog:
+                # the summary is at the end of the nosetests output
+                print('worker %d: %s' % (worker, ' '.join(fdLog.read().split('\n')[-4:]).strip()))
+    print('%d modules in %d workers took %.0fs' % (len(parallel), len(processes), time.monotonic() - start))
+
+    if serial:
+        serialStart = time.monotonic()
+        if subprocess.call(['nosetests', '--with-xunit', '--xunit-file=nosetests-serial.xml'] + serial) != 0:
+            failed = True
+            dumpLogs(os.path.join('configs', '*.log'))
+        print('%d serial modules took %.0fs' % (len(serial), time.monotonic() - serialStart))
+
+    print('Total: %.0fs' % (time.monotonic() - start))
+    sys.exit(1 if failed else 0)
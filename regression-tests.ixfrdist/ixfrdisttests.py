@@ -1,22 +1,24 @@
 #!/usr/bin/env python2
 
-import errno
 import shutil
 import os
 import socket
 import struct
 import subprocess
 import sys
-import time
 import unittest
 import dns
 import dns.message
 
 from eqdnsmessage import AssertEqualDNSMessageMixin
+from readiness import waitForExit, waitForReadiness
 
 class IXFRDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
 
+    # the time ixfrdist used to be given to start, now only used to report
+    # how much waiting for its sockets saved
     _ixfrDistStartupDelay = 2.0
+    _ixfrDistStartupTimeout = 10.0
     _ixfrDistPort = 5342
 
     _config_template = """
@@ -62,7 +64,13 @@ failed-soa-retry: 3
         else:
             delay = cls._ixfrDistStartupDelay
 
-        time.sleep(delay)
+        listening = [('127.0.0.1', cls._ixfrDistPort)]
+        answering = []
+        webserverAddress = getattr(cls, 'webserver_address', None)
+        if webserverAddress and 'webserver_address' in cls._config_params:
+            address, port = webserverAddress.rsplit(':', 1)
+            answering.append((address, int(port)))
+        waitForReadiness(cls._ixfrdist, listening, answering, logFile, timeout=cls._ixfrDistStartupTimeout, fixedDelay=delay)
 
         if cls._ixfrdist.poll() is not None:
             cls._ixfrdist.kill()
@@ -93,20 +101,8 @@ failed-soa-retry: 3
         else:
             delay = 1.0
 
-        try:
-            if cls._ixfrdist:
-                cls._ixfrdist.terminate()
-                if cls._ixfrdist.poll() is None:
-                    time.sleep(delay)
-                    if cls._ixfrdist.poll() is None:
-                        cls._ixfrdist.kill()
-                    cls._ixfrdist.wait()
-        except OSError as e:
-            # There is a race-condition with the poll() and
-            # kill() statements, when the process is dead on the
-            # kill(), this is fine
-            if e.errno != errno.ESRCH:
-                raise
+        if cls._ixfrdist:
+            waitForExit(cls._ixfrdist, timeout=delay, fixedDelay=delay)
 
     @classmethod
     def sendUDPQuery(cls, query, timeout=2.0, decode=True, fwparams=dict()):
@@ -1,6 +1,9 @@
 #!/usr/bin/env python2
 
 from __future__ import print_function
+import atexit
+import concurrent.futures
+import hashlib
 import errno
 import shutil
 import os
@@ -16,6 +19,7 @@ import dns.message
 from proxyprotocol import ProxyProtocol
 
 from eqdnsmessage import AssertEqualDNSMessageMixin
+from dnsseccache import runPdnsutil
 
 
 def have_ipv6():
@@ -32,6 +36,25 @@ def have_ipv6():
     return False
 
 
+# The auths started by RecursorTest.setUpClass are kept running after the
+# class is done, and reused by the next classes needing the exact same auths,
+# see RecursorTest.startSharedAuths.
+_sharedAuths = {'fingerprint': None, 'processes': {}}
+_authLaunches = 0
+
+def stopSharedAuths():
+    for auth in _sharedAuths['processes'].values():
+        RecursorTest.killProcess(auth)
+    _sharedAuths['processes'] = {}
+    _sharedAuths['fingerprint'] = None
+
+def _stopSharedAuthsAtExit():
+    stopSharedAuths()
+    if _authLaunches:
+        print('%d pdns_server processes were started' % (_authLaunches), file=sys.stderr)
+
+atexit.register(_stopSharedAuthsAtExit)
+
 class RecursorTest(AssertEqualDNSMessageMixin, unittest.TestCase):
     """
     Setup all recursors and auths required for the tests
@@ -483,20 +506,21 @@ distributor-threads={threads}""".format(confdir=confdir,
                        bind_dnssec_db]
 
         print(' '.join(pdnsutilCmd))
-        try:
-            subprocess.check_output(pdnsutilCmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            raise AssertionError('%s failed (%d): %s' % (pdnsutilCmd, e.returncode, e.output))
+        runPdnsutil(bind_dnssec_db, ['create-bind-db'], pdnsutilCmd)
 
     @classmethod
     def secureZone(cls, confdir, zonename, key=None):
         zone = '.' if zonename == 'ROOT' else zonename
+        with open(os.path.join(confdir, '%s.zone' % zonename)) as zonefile:
+            zonecontent = zonefile.read()
         if not key:
+            step = ['secure-zone', zone, zonecontent]
             pdnsutilCmd = [os.environ['PDNSUTIL'],
                            '--config-dir=%s' % confdir,
                            'secure-zone',
                            zone]
         else:
+            step = ['import-zone-key', zone, zonecontent, key]
             keyfile = os.path.join(confdir, 'dnssec.key')
             with open(keyfile, 'w') as fdKeyfile:
                 fdKeyfile.write(key)
@@ -510,38 +534,112 @@ distributor-threads={threads}""".format(confdir=confdir,
                            'ksk']
 
         print(' '.join(pdnsutilCmd))
-        try:
-            subprocess.check_output(pdnsutilCmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            raise AssertionError('%s failed (%d): %s' % (pdnsutilCmd, e.returncode, e.output))
+        runPdnsutil(os.path.join(confdir, 'bind-dnssec.sqlite3'), step, pdnsutilCmd)
+
+    @classmethod
+    def generateOneAuthConfig(cls, confdir, auth_suffix, zoneinfo):
+        threads = zoneinfo['threads']
+        zones = zoneinfo['zones']
+        authconfdir = os.path.join(confdir, 'auth-%s' % auth_suffix)
+
+        os.mkdir(authconfdir)
+
+        cls.generateAuthConfig(authconfdir, threads)
+        cls.generateAuthNamedConf(authconfdir, zones)
+
+        for zone in zones:
+            cls.generateAuthZone(authconfdir,
+                                 zone,
+                                 cls._zones[zone])
+            if cls._zone_keys.get(zone, None):
+                cls.secureZone(authconfdir, zone, cls._zone_keys.get(zone))
 
     @classmethod
     def generateAllAuthConfig(cls, confdir):
         if cls._auth_zones:
-            for auth_suffix, zoneinfo in cls._auth_zones.items():
-                threads = zoneinfo['threads']
-                zones = zoneinfo['zones']
-                authconfdir = os.path.join(confdir, 'auth-%s' % auth_suffix)
+            # Every auth has its own directory and bind-dnssec database, so
+            # they can be set up concurrently, the actual work being done by
+            # the pdnsutil processes. The zones of an auth are still secured
+            # one after the other.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(cls._auth_zones)) as executor:
+                futures = [executor.submit(cls.generateOneAuthConfig, confdir, auth_suffix, zoneinfo)
+                           for auth_suffix, zoneinfo in cls._auth_zones.items()]
+                for future in futures:
+                    future.result()
+
+    @classmethod
+    def getAuthsFingerprint(cls):
+        """
+        Returns a digest of everything the auths of this class depend on, so
+        that classes with the same one can share them.
+        """
+        methods = [getattr(cls, name).__func__ for name in ['generateOneAuthConfig', 'generateAuthConfig', 'generateAuthNamedConf', 'generateAuthZone', 'secureZone', 'launchAuth']]
+        inputs = [cls._PREFIX, cls._SOA,
+                  sorted(cls._auth_zones.items()), sorted(cls._zones.items()), sorted(cls._zone_keys.items()),
+                  cls._auth_cmd, sorted(cls._auth_env.items()),
+                  ['%s.%s' % (method.__module__, method.__qualname__) for method in methods]]
+        return hashlib.sha256(repr(inputs).encode()).hexdigest()
+
+    @classmethod
+    def startSharedAuths(cls, confdir):
+        """
+        Makes sure the auths of this class are running, reusing the ones
+        already started for a previous class if it had the same zones, keys
+        and settings, and replacing them otherwise. Their directories are
+        linked from confdir, where printlogs.py looks for their logs.
+        """
+        if not cls._auth_zones:
+            stopSharedAuths()
+            return
 
-                os.mkdir(authconfdir)
+        fingerprint = cls.getAuthsFingerprint()
+        authsdir = 'auths-%s' % (fingerprint[:12])
+        for auth_suffix in cls._auth_zones:
+            os.symlink(os.path.join('..', authsdir, 'auth-%s' % auth_suffix),
+                       os.path.join(confdir, 'auth-%s' % auth_suffix))
 
-                cls.generateAuthConfig(authconfdir, threads)
-                cls.generateAuthNamedConf(authconfdir, zones)
+        if fingerprint == _sharedAuths['fingerprint']:
+            if all(auth.poll() is None for auth in _sharedAuths['processes'].values()):
+                print("Reusing the running auths..")
+                return
+        stopSharedAuths()
 
-                for zone in zones:
-                    cls.generateAuthZone(authconfdir,
-                                         zone,
-                                         cls._zones[zone])
-                    if cls._zone_keys.get(zone, None):
-                        cls.secureZone(authconfdir, zone, cls._zone_keys.get(zone))
+        confdir = os.path.join('configs', authsdir)
+        cls.createConfigDir(confdir)
+        cls.generateAllAuthConfig(confdir)
+        processes = cls.startAllAuth(confdir)
+        # they are no longer ours to kill in tearDownAuth
+        for ipaddress in processes:
+            del cls._auths[ipaddress]
+        _sharedAuths['processes'] = processes
+        _sharedAuths['fingerprint'] = fingerprint
 
     @classmethod
     def startAllAuth(cls, confdir):
         if cls._auth_zones:
-            for auth_suffix, _ in cls._auth_zones.items():
-                authconfdir = os.path.join(confdir, 'auth-%s' % auth_suffix)
-                ipaddress = cls._PREFIX + '.' + auth_suffix
-                cls.startAuth(authconfdir, ipaddress)
+            return cls.startAuths(confdir, cls._auth_zones.keys())
+        return {}
+
+    @classmethod
+    def startAuths(cls, confdir, auth_suffixes):
+        """
+        Launches the auths then waits for all of them at the same time, so
+        that it takes as long as the slowest one to start. Returns the
+        processes, by address.
+        """
+        launched = []
+        for auth_suffix in auth_suffixes:
+            authconfdir = os.path.join(confdir, 'auth-%s' % auth_suffix)
+            ipaddress = cls._PREFIX + '.' + auth_suffix
+            launched.append((ipaddress,) + cls.launchAuth(authconfdir, ipaddress))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(launched)) as executor:
+            futures = [executor.submit(cls.waitForAuth, ipaddress, authcmd, logFile)
+                       for ipaddress, authcmd, logFile in launched]
+            for future in futures:
+                future.result()
+
+        return {ipaddress: cls._auths[ipaddress] for ipaddress, _, _ in launched}
 
     @classmethod
     def waitForTCPSocket(cls, ipaddress, port):
@@ -559,6 +657,15 @@ distributor-threads={threads}""".format(confdir=confdir,
 
     @classmethod
     def startAuth(cls, confdir, ipaddress):
+        authcmd, logFile = cls.launchAuth(confdir, ipaddress)
+        cls.waitForAuth(ipaddress, authcmd, logFile)
+
+    @classmethod
+    def launchAuth(cls, confdir, ipaddress):
+        global _authLaunches
+        if ipaddress in _sharedAuths['processes']:
+            stopSharedAuths()
+        _authLaunches += 1
         print("Launching pdns_server..")
         authcmd = list(cls._auth_cmd)
         authcmd.append('--config-dir=%s' % confdir)
@@ -574,7 +681,10 @@ distributor-threads={threads}""".format(confdir=confdir,
             cls._auths[ipaddress] = subprocess.Popen(authcmd, close_fds=True,
                                                      stdout=fdLog, stderr=fdLog,
                                                      env=cls._auth_env)
+        return authcmd, logFile
 
+    @classmethod
+    def waitForAuth(cls, ipaddress, authcmd, logFile):
         cls.waitForTCPSocket(ipaddress, 53)
 
         if cls._auths[ipaddress].poll() is not None:
@@ -657,6 +767,11 @@ distributor-threads={threads}""".format(confdir=confdir,
 
     @classmethod
     def setUpSockets(cls):
+        # classes with their own setUpClass might not want any auth, or
+        # other ones, to be running
+        if cls.setUpClass.__func__ is not RecursorTest.setUpClass.__func__:
+            stopSharedAuths()
+
         print("Setting up UDP socket..")
         cls._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         cls._sock.settimeout(2.0)
@@ -670,8 +785,7 @@ distributor-threads={threads}""".format(confdir=confdir,
 
         confdir = os.path.join('configs', cls._confdir)
         cls.createConfigDir(confdir)
-        cls.generateAllAuthConfig(confdir)
-        cls.startAllAuth(confdir)
+        cls.startSharedAuths(confdir)
 
         cls.generateRecursorConfig(confdir)
         cls.startRecursor(confdir, cls._recursorPort)
@@ -715,6 +829,7 @@ distributor-threads={threads}""".format(confdir=confdir,
     def tearDownAuth(cls):
         for _, auth in cls._auths.items():
             cls.killProcess(auth);
+        cls._auths.clear()
 
     @classmethod
     def tearDownRecursor(cls):
@@ -21,10 +21,7 @@ class RecursorEDNSPaddingTest(RecursorTest):
 
         # we only need these auths and this cuts the needed time in half
         if cls._auth_zones:
-            for auth_suffix in ['8', '9', '10']:
-                authconfdir = os.path.join(confdir, 'auth-%s' % auth_suffix)
-                ipaddress = cls._PREFIX + '.' + auth_suffix
-                cls.startAuth(authconfdir, ipaddress)
+            cls.startAuths(confdir, ['8', '9', '10'])
 
         cls.generateRecursorConfig(confdir)
         cls.startRecursor(confdir, cls._recursorPort)